@@ -1,25 +1,204 @@
 import asyncio
+import ssl
+import bisect
+import contextvars
 import json
+import mimetypes
 import os
 import io
 import base64
 import random
-from typing import Optional, List, Dict, Any
+import gzip
+import hashlib
+import re
+import shutil
+import signal
+import sqlite3
+import threading
+import tempfile
+import time
+import uuid
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, List, Dict, Any, Union, BinaryIO, Set, Tuple
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import Response, FileResponse, StreamingResponse, JSONResponse
+from starlette.datastructures import UploadFile
+from starlette.formparsers import MultiPartParser, MultiPartException
+from starlette.routing import Match
 from pydantic import BaseModel
 import httpx
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps
+import aiohttp
 import edge_tts
-from gtts import gTTS
+from gtts import gTTS, gTTSError
 import genanki
 
+try:
+    import pypdfium2 as pdfium  # 可选：批量 OCR 上传 PDF 时用来逐页渲染
+except ImportError:
+    pdfium = None
+
+try:
+    # Edge TTS 连接池直接复用 edge_tts 内部的协议工具 (私有接口，requirements.txt 里把 edge-tts 锁在 7.3.x)；缺模块时退回每次新建连接的 Communicate
+    import certifi
+    from xml.sax.saxutils import escape as xml_escape
+    from edge_tts.communicate import connect_id, date_to_string, get_headers_and_data, mkssml, remove_incompatible_characters, split_text_by_byte_length, ssml_headers_plus_data
+    from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+    from edge_tts.data_classes import TTSConfig
+    from edge_tts.drm import DRM
+    EDGE_POOL_AVAILABLE = True
+except ImportError:
+    EDGE_POOL_AVAILABLE = False
+
+try:
+    import brotli  # 可选：前端静态资源额外预压缩一份 br，没装就只有 gzip
+except ImportError:
+    brotli = None
+
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2，没装就退回 HTTP/1.1
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # ================= 1. 配置 =================
 DEFAULT_BASE_URL = "https://api.siliconflow.cn/v1"
+DEFAULT_CHAT_MODEL = "deepseek-ai/DeepSeek-V3"
+DEFAULT_OCR_MODEL = "Qwen/Qwen2.5-VL-72B-Instruct"
 VOCAB_FILE = "my_vocab.json"
+# 生词本存储后端："sqlite" (默认，首次启动自动从 VOCAB_FILE 迁移) 或 "json" (旧格式)
+VOCAB_BACKEND = "sqlite"
+VOCAB_DB_FILE = "my_vocab.db"
+VOCAB_PAGE_MAX = 1000
+VOCAB_CHANGELOG_MAX = 10000
+
+# TTS 音频缓存：内存 LRU + 磁盘目录，两级各自限额 (字节)
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEM_BYTES = 64 * 1024 * 1024
+TTS_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+# /tts 的成品音频按内容哈希存进磁盘缓存，通过 GET /audio/{hash} 提供；内容不会变，浏览器/CDN 可以永久缓存
+AUDIO_URL_MAX_AGE = 365 * 24 * 3600
+
+# 前端静态文件：启动时把 frontend/dist 读进内存并预压缩；Vite 打到 assets/ 下、文件名带内容哈希的资源永久缓存，其余靠 ETag 协商
+# (只认 assets/，public/ 里原样拷贝的 apple-touch-icon.png、site-manifest.json 之类名字里也有 '-'，不能当成带哈希)
+FRONTEND_DIST_DIR = "frontend/dist"
+STATIC_COMPRESS_MIN_BYTES = 512
+STATIC_IMMUTABLE_PATH = r"^assets/[^/]+-[A-Za-z0-9_-]{8,}\.[a-z0-9]+$"
+STATIC_DEFAULT_MAX_AGE = 3600
+
+# 长文本分句并发合成：超过阈值的文本按句切分，每段单独合成、单独缓存，再按顺序拼接
+TTS_SEGMENT_THRESHOLD = 300
+TTS_SEGMENT_MIN_CHARS = 40
+TTS_SEGMENT_MAX_CHARS = 400
+TTS_SEGMENT_CONCURRENCY = 4
+
+# gTTS 专用线程池 (不占默认 executor)；gTTS 把文本切成 ~100 字符的小片逐个请求，这里改成并发请求再按顺序拼接
+GTTS_WORKERS = 8
+GTTS_CHUNK_CONCURRENCY = 4  # 单次合成同时在途的分片请求数
+
+# 查词缓存：持久化索引 + 内存 LRU；模型结果超过 TTL (秒) 视为过期，生词本里的词条不过期
+LOOKUP_CACHE_DB_FILE = "lookup_cache.db"
+LOOKUP_CACHE_MEM_ITEMS = 5000
+LOOKUP_CACHE_TTL = 30 * 24 * 3600
+
+# 批量查词：一次补全最多打包的单词数，以及按估算 token 数 (输入 + 预计输出) 的预算
+LOOKUP_BATCH_MAX_WORDS = 60
+LOOKUP_BATCH_TOKEN_BUDGET = 4000
+LOOKUP_BATCH_TOKENS_PER_RESULT = 50
+LOOKUP_BATCH_CONCURRENCY = 3
+
+# 长文翻译：按段落切分并发翻译，超长段落再按句切；译文按 (模型, 段落) 内容哈希缓存在内存 LRU
+TRANSLATE_PARAGRAPH_MAX_CHARS = 1500
+TRANSLATE_CONCURRENCY = 4
+TRANSLATE_CACHE_ITEMS = 2000
+
+# OCR 图片预处理：在独立线程池里解码/缩放/重编码，不占事件循环
+# 已经是小 JPEG 且无需旋转的图片直接透传，不再重新编码
+OCR_MAX_SIDE = 1024
+OCR_JPEG_QUALITY = 85
+OCR_GRAYSCALE = True
+OCR_PASSTHROUGH_BYTES = 512 * 1024
+OCR_IMAGE_WORKERS = 2
+# /ocr/upload：请求体上限 (超过即 413，不等读完)，以及上传内容在内存里暂存的上限 (超过落盘)
+OCR_UPLOAD_MAX_BYTES = 20 * 1024 * 1024
+OCR_SPOOL_MEMORY = 1024 * 1024
+# /ocr/batch：页数/总大小上限，视觉模型并发数与相邻两次调用的最小间隔 (秒)
+OCR_BATCH_MAX_PAGES = 50
+OCR_BATCH_MAX_BYTES = 100 * 1024 * 1024
+OCR_BATCH_CONCURRENCY = 3
+OCR_BATCH_MIN_INTERVAL = 0.2
+
+# OCR 结果缓存：按预处理后图片的 dHash (感知哈希) 查找，汉明距离不超过阈值即视为同一页
+# 文字页在 8x8 下太相像，默认用 16x16 (256 位) 的哈希
+OCR_CACHE_DB_FILE = "ocr_cache.db"
+OCR_CACHE_MAX_ENTRIES = 5000
+OCR_DHASH_SIZE = 16
+OCR_CACHE_MAX_DISTANCE = 24
+# dHash 对只有一两行字的页 (章节标题页) 区分不开，近似命中后还要用墨迹区域的缩略图确认：
+# 逐个 8x8 小块比较灰度，最大块差超过阈值就不算同一页 (同页重新压缩/缩放约 0.1 以内，换了一个字 0.4 以上)
+OCR_SIGNATURE_SIZE = (128, 64)
+OCR_SIGNATURE_MAX_BLOCK_DIFF = 0.12
+
+# Anki 导出时并发合成单词发音的上限
+ANKI_AUDIO_CONCURRENCY = 8
+# 后台导出任务：同时执行的任务数、排队上限、成品保留时间 (秒)
+ANKI_JOB_WORKERS = 2
+ANKI_JOB_MAX_PENDING = 20
+ANKI_JOB_TTL = 3600
+
+# TTS 引擎故障转移：按语言配置引擎优先级，用户选的引擎排第一；近期失败率高的引擎挪到最后再试
+TTS_FAILOVER_CHAINS = {
+    "🇬🇧 英语": ["Edge", "SiliconFlow", "Google"],
+    "🇨🇳 中文": ["Edge", "SiliconFlow", "Google"],
+    "🇷🇺 俄语": ["Edge", "Google"],
+    "🇫🇷 法语": ["Edge", "Google"],
+    "🇩🇪 德语": ["Edge", "Google"],
+}
+TTS_FAILOVER_SF_VOICE = "FunAudioLLM/CosyVoice2-0.5B:alex"
+TTS_ENGINE_HEALTH_WINDOW = 120.0   # 只看最近这么多秒内的结果，过期后引擎自动恢复优先级
+TTS_ENGINE_MIN_SAMPLES = 5
+TTS_ENGINE_MAX_FAILURE_RATE = 0.5
+
+# Edge TTS 连接池：复用握手好的 WebSocket，短句只付合成时间。音色写在每次请求的 SSML 里，所有音色共用一个池
+EDGE_POOL_SIZE = 4  # 最多保留的空闲连接 (0 = 关闭连接池)
+EDGE_POOL_MIN_IDLE = 1  # 最近有 Edge 请求时后台保持预热的空闲连接数
+EDGE_POOL_WARM_WINDOW = 600.0  # 超过这么久没有 Edge 请求就不再预热
+EDGE_POOL_IDLE_TIMEOUT = 60.0
+EDGE_POOL_MAX_AGE = 300.0
+EDGE_POOL_CHECK_INTERVAL = 10.0
+
+# 上游配额：按 API Key 和按上游各一套令牌桶 (速率/突发) + 并发上限，排不上队或等待超过期限就返回 429
+# 上游回 429 时按 Retry-After 暂停该 Key (没有 Key 的引擎暂停整个上游)，并把速率减半，之后逐步恢复
+QUOTA_KEY_RATE = 2.0
+QUOTA_KEY_BURST = 6
+QUOTA_KEY_CONCURRENCY = 4
+QUOTA_PROVIDER_RATE = 20.0
+QUOTA_PROVIDER_BURST = 40
+QUOTA_PROVIDER_CONCURRENCY = 32
+QUOTA_MAX_QUEUE = 32
+QUOTA_MAX_WAIT = 5.0
+QUOTA_DEFAULT_PENALTY = 2.0
+
+# 上游容错：有限次数重试 (全抖动指数退避)、慢请求对冲、按上游分别熔断
+UPSTREAM_RETRIES = 2
+UPSTREAM_BACKOFF_BASE = 0.3
+UPSTREAM_BACKOFF_MAX = 4.0
+UPSTREAM_HEDGE_PERCENTILE = 0.95  # 开了对冲的调用，单次尝试超过同类调用近期 p95 延迟仍未返回就再发一个；None 全部关闭
+UPSTREAM_HEDGE_MIN_SAMPLES = 20
+UPSTREAM_BREAKER_FAILURES = 5     # 连续失败这么多次后熔断
+UPSTREAM_BREAKER_COOLDOWN = 30.0  # 熔断多久后放一个探测请求
+
+# 上游 HTTP 连接池：每个 base_url 一个长连接 AsyncClient，可按 base_url 单独覆盖池参数
+HTTP_POOL_LIMITS = {"max_connections": 100, "max_keepalive_connections": 20, "keepalive_expiry": 60.0}
+HTTP_POOL_LIMITS_BY_URL: Dict[str, Dict[str, Any]] = {}
+# 默认地址和上面配置过的地址常驻；请求里自带的其他 base_url 最多保留这么多个客户端，超出关掉最久没用的
+HTTP_CLIENTS_MAX = 16
+HTTP_CLIENT_CLOSE_DELAY = 90.0  # 被淘汰的客户端晚一点再关，让在途请求 (最长超时 60 秒) 先跑完
 
 VOICE_MAP_EDGE = {
     "🇬🇧 英语": [("en-GB-RyanNeural", "Ryan (英/男)"), ("en-US-ChristopherNeural", "Chris (美/男)"), ("en-US-AriaNeural", "Aria (美/女)")],
@@ -36,95 +215,1855 @@ VOICE_MAP_SF = {
 }
 LANG_MAP_GOOGLE = {"🇬🇧 英语": "en", "🇫🇷 法语": "fr", "🇩🇪 德语": "de", "🇷🇺 俄语": "ru", "🇨🇳 中文": "zh"}
 
-def load_vocab_data():
-    if os.path.exists(VOCAB_FILE):
-        try: return json.load(open(VOCAB_FILE, "r", encoding="utf-8"))
-        except: return []
-    return []
+VOCAB_FIELDS = ("word", "lang", "ipa", "zh", "ru", "date")
+
+# /metrics 直方图的桶 (秒)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics:
+    """进程内的 Prometheus 风格指标 (计数器 / 仪表 / 直方图)，标签用关键字参数传，render() 输出文本格式。
+
+    多 worker 部署时每个进程各有一份，需要逐个实例抓取。stage() 既可以当 with 语句，也可以当同步函数的装饰器。
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._types: Dict[str, str] = {}
+        self._values: Dict[tuple, float] = {}
+        self._hists: Dict[tuple, list] = {}  # [各桶计数..., +Inf 计数, sum]
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, "counter")
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, kind: str = "gauge", **labels):
+        # 缓存命中数这类别处已经累计好的计数器也用 set 导出，kind 传 "counter"
+        with self._lock:
+            self._types.setdefault(name, kind)
+            self._values[self._key(name, labels)] = float(value)
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, "histogram")
+            hist = self._hists.get(key)
+            if hist is None: hist = self._hists[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            hist[bisect.bisect_left(self.buckets, value)] += 1
+            hist[-1] += value
+
+    @contextmanager
+    def stage(self, stage: str):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe("stage_duration_seconds", time.perf_counter() - t0, stage=stage)
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+    def render(self) -> str:
+        with self._lock:
+            values, hists, types = dict(self._values), {k: list(v) for k, v in self._hists.items()}, dict(self._types)
+        lines = []
+        for name in sorted(types):
+            lines.append(f"# TYPE {name} {types[name]}")
+            for (n, pairs), value in sorted(values.items()):
+                if n == name: lines.append(f"{name}{self._labels(pairs)} {value:g}")
+            for (n, pairs), hist in sorted(hists.items()):
+                if n != name: continue
+                cumulative = 0
+                for bound, count in zip([f"{b:g}" for b in self.buckets] + ["+Inf"], hist[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(pairs + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(pairs)} {hist[-1]:g}")
+                lines.append(f"{name}_count{self._labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+# 当前上游调用的模型名，由发起方设置，UpstreamGuard 记录状态码时作为标签
+upstream_model: contextvars.ContextVar[str] = contextvars.ContextVar("upstream_model", default="")
+
+class JSONVocabStore:
+    """旧的整文件 JSON 存储，每次读写都重新解析/重写 VOCAB_FILE，最新的单词排在最前"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> List[Dict[str, Any]]:
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f: return json.load(f)
+            except: return []
+        return []
+
+    def _save(self, data):
+        try:
+            with open(self.path, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False, indent=2)
+        except: pass
+
+    def list_all(self) -> List[Dict[str, Any]]:
+        return self._load()
+
+    def find(self, words: List[str]) -> List[Dict[str, Any]]:
+        targets = set(words)
+        return [x for x in self._load() if x.get("word") in targets]
+
+    def query(self, limit=None, cursor=None, lang=None, prefix=None, date_from=None, date_to=None):
+        # JSON 后端只能全量过滤，游标就是列表下标
+        items = [x for x in self._load() if (lang is None or x.get("lang") == lang)
+                 and (prefix is None or str(x.get("word", "")).startswith(prefix))
+                 and (date_from is None or (x.get("date") or "") >= date_from)
+                 and (date_to is None or (x.get("date") or "") <= date_to)]
+        start = int(cursor) if cursor and cursor.isdigit() else 0
+        if limit is None: return items[start:], None
+        end = start + limit
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def version(self) -> str:
+        try: st = os.stat(self.path)
+        except OSError: return "json-0"
+        return f"json-{st.st_mtime_ns}-{st.st_size}"
+
+    def changes(self, since: int):
+        # 不记录变更日志，客户端只能全量重拉
+        return 0, None
+
+    def add(self, item: Dict[str, Any]):
+        with self._lock:
+            v = self._load()
+            for x in v:
+                if x.get("word") == item["word"] and x.get("lang") == item.get("lang"): return x, False
+            v.insert(0, item)
+            self._save(v)
+            return item, True
+
+    def delete(self, word: str, lang: Optional[str] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            v = self._load()
+            hit = lambda x: x.get("word") == word and (lang is None or x.get("lang") == lang)
+            removed = [x for x in v if hit(x)]
+            if removed: self._save([x for x in v if not hit(x)])
+            return removed
 
-def save_vocab_data(data):
-    try: json.dump(data, open(VOCAB_FILE, "w", encoding="utf-8"), ensure_ascii=False, indent=2)
-    except: pass
+class SQLiteVocabStore:
+    """SQLite 生词本 (WAL 模式)，(word, lang) 唯一索引，增删都是索引操作而不是整表重写。
 
-def compress_image(image_bytes: bytes) -> str:
+    自增 id 记录加入顺序，列表按 id 倒序返回，和旧 JSON 文件"最新在前"的顺序一致，
+    分页游标就是上一页最后一条的 id。增删同时写入 vocab_changes 变更日志，供增量同步。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS vocab (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                word TEXT NOT NULL, lang TEXT NOT NULL DEFAULT '',
+                ipa TEXT DEFAULT '', zh TEXT DEFAULT '', ru TEXT DEFAULT '', date TEXT DEFAULT '')""")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS vocab_word_lang ON vocab (word, lang)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS vocab_lang ON vocab (lang, id)")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS vocab_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, word TEXT NOT NULL, lang TEXT NOT NULL, item TEXT)""")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            # epoch 标识这个数据库实例，删库重建后旧的 ETag / 变更序号不会被误认
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (os.urandom(4).hex(),))
+            self.epoch = self._conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+
+    @staticmethod
+    def _row(row) -> Dict[str, Any]:
+        return {"id": row["id"], **{k: row[k] for k in VOCAB_FIELDS}}
+
+    def _log(self, op: str, item: Dict[str, Any]):
+        self._conn.execute("INSERT INTO vocab_changes (op, word, lang, item) VALUES (?,?,?,?)",
+                           (op, item["word"], item["lang"], json.dumps(item, ensure_ascii=False)))
+        self._conn.execute("DELETE FROM vocab_changes WHERE seq <= (SELECT MAX(seq) FROM vocab_changes) - ?", (VOCAB_CHANGELOG_MAX,))
+
+    def list_all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self._row(r) for r in self._conn.execute("SELECT * FROM vocab ORDER BY id DESC")]
+
+    def find(self, words: List[str]) -> List[Dict[str, Any]]:
+        words, rows = list(dict.fromkeys(words)), []
+        with self._lock:
+            # 分批查询，避开 SQLite 单条语句的参数个数上限
+            for i in range(0, len(words), 500):
+                batch = words[i:i + 500]
+                rows += self._conn.execute(f"SELECT * FROM vocab WHERE word IN ({','.join('?' * len(batch))})", batch).fetchall()
+        return [self._row(r) for r in sorted(rows, key=lambda r: r["id"], reverse=True)]
+
+    def query(self, limit=None, cursor=None, lang=None, prefix=None, date_from=None, date_to=None):
+        where, args = [], []
+        if cursor and cursor.isdigit(): where.append("id < ?"); args.append(int(cursor))
+        if lang is not None: where.append("lang = ?"); args.append(lang)
+        # 前缀用区间条件，能走 (word, lang) 索引
+        if prefix: where.append("word >= ? AND word < ?"); args += [prefix, prefix + "\U0010ffff"]
+        if date_from: where.append("date >= ?"); args.append(date_from)
+        if date_to: where.append("date <= ?"); args.append(date_to)
+        sql = "SELECT * FROM vocab" + (f" WHERE {' AND '.join(where)}" if where else "") + " ORDER BY id DESC"
+        if limit is not None: sql += f" LIMIT {int(limit) + 1}"
+        with self._lock: rows = self._conn.execute(sql, args).fetchall()
+        if limit is not None and len(rows) > limit: return [self._row(r) for r in rows[:limit]], str(rows[limit - 1]["id"])
+        return [self._row(r) for r in rows], None
+
+    def version(self) -> str:
+        with self._lock: seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM vocab_changes").fetchone()[0]
+        return f"{self.epoch}-{seq}"
+
+    def changes(self, since: int):
+        # 返回 (当前序号, since 之后的变更)；since 早于日志保留范围或不属于本库时返回 None，客户端需全量重拉
+        with self._lock:
+            lo, hi = self._conn.execute("SELECT MIN(seq), COALESCE(MAX(seq), 0) FROM vocab_changes").fetchone()
+            if since > hi or (lo is not None and since < lo - 1): return hi, None
+            rows = self._conn.execute("SELECT * FROM vocab_changes WHERE seq > ? ORDER BY seq", (since,)).fetchall()
+        return hi, [{"seq": r["seq"], "op": r["op"], "word": r["word"], "lang": r["lang"], "item": json.loads(r["item"])} for r in rows]
+
+    def add(self, item: Dict[str, Any]):
+        # 返回 (记录, 是否新增)；已存在时返回库里原有的那条
+        values = [item.get(k) or "" for k in VOCAB_FIELDS]
+        with self._lock, self._conn:
+            cur = self._conn.execute(f"INSERT OR IGNORE INTO vocab ({','.join(VOCAB_FIELDS)}) VALUES (?,?,?,?,?,?)", values)
+            created = cur.rowcount > 0
+            record = self._row(self._conn.execute("SELECT * FROM vocab WHERE word = ? AND lang = ?", (values[0], values[1])).fetchone())
+            if created: self._log("add", record)
+            return record, created
+
+    def delete(self, word: str, lang: Optional[str] = None) -> List[Dict[str, Any]]:
+        cond, args = ("word = ?", (word,)) if lang is None else ("word = ? AND lang = ?", (word, lang))
+        with self._lock, self._conn:
+            removed = [self._row(r) for r in self._conn.execute(f"SELECT * FROM vocab WHERE {cond}", args)]
+            self._conn.execute(f"DELETE FROM vocab WHERE {cond}", args)
+            for record in removed: self._log("delete", record)
+            return removed
+
+    def migrate_from_json(self, json_path: str) -> int:
+        # 一次性迁移：meta 表里记下已迁移，之后即使 JSON 文件还在也不再导入
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone(): return 0
+        items = JSONVocabStore(json_path).list_all()
+        with self._lock, self._conn:
+            # JSON 里最新的在最前，倒序插入让自增 id 保持原来的先后顺序
+            cur = self._conn.executemany(
+                f"INSERT OR IGNORE INTO vocab ({','.join(VOCAB_FIELDS)}) VALUES (?,?,?,?,?,?)",
+                [[x.get(k) or "" for k in VOCAB_FIELDS] for x in reversed(items) if isinstance(x, dict) and x.get("word")])
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (json_path,))
+            return max(cur.rowcount, 0)
+
+def normalize_word(word: str) -> str:
+    return unicodedata.normalize("NFC", (word or "").strip()).casefold()
+
+class LookupCache:
+    """查词结果缓存，键是 (规范化单词, chat_model)。
+
+    持久层是一张 SQLite 表，启动时用生词本里已有的 ipa/zh/ru 预填 (model 记为空串，
+    任何模型都能命中，且不受 TTL 限制)；内存层是按条数限额的 LRU。
+    """
+    FIELDS = ("lang", "ipa", "zh", "ru")
+
+    def __init__(self, path: str, mem_items: int, ttl: float):
+        self.mem_items = mem_items
+        self.ttl = ttl
+        self._mem: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.stats = {"mem_hits": 0, "db_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS lookup (
+                word TEXT NOT NULL, model TEXT NOT NULL, result TEXT NOT NULL, ts REAL NOT NULL,
+                PRIMARY KEY (word, model))""")
+
+    def _fresh(self, model: str, ts: float) -> bool:
+        return model == "" or time.time() - ts < self.ttl
+
+    def _mem_put(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_items: self._mem.popitem(last=False)
+
+    def get(self, word: str, model: str) -> Optional[Dict[str, Any]]:
+        norm = normalize_word(word)
+        for key in ((norm, model), (norm, "")):
+            hit = self._mem.get(key)
+            if hit and self._fresh(key[1], hit[1]):
+                self._mem.move_to_end(key)
+                self.stats["mem_hits"] += 1
+                return dict(hit[0])
+        with self._lock:
+            rows = self._conn.execute("SELECT model, result, ts FROM lookup WHERE word = ? AND model IN (?, '') ORDER BY model DESC",
+                                      (norm, model)).fetchall()
+        for m, result, ts in rows:
+            if self._fresh(m, ts):
+                value = json.loads(result)
+                self._mem_put((norm, m), (value, ts))
+                self.stats["db_hits"] += 1
+                return dict(value)
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, word: str, model: str, result: Dict[str, Any]):
+        norm, ts = normalize_word(word), time.time()
+        value = {k: result.get(k, "") for k in self.FIELDS}
+        self._mem_put((norm, model), (value, ts))
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO lookup (word, model, result, ts) VALUES (?,?,?,?)",
+                               (norm, model, json.dumps(value, ensure_ascii=False), ts))
+
+    def seed(self, items: List[Dict[str, Any]]):
+        # 只收录已经有释义/音标的生词，空词条没有参考价值
+        ts = time.time()
+        rows = [(normalize_word(x["word"]), "", json.dumps({k: x.get(k) or "" for k in self.FIELDS}, ensure_ascii=False), ts)
+                for x in items if x.get("word") and (x.get("zh") or x.get("ipa") or x.get("ru"))]
+        for row in rows: self._mem.pop((row[0], ""), None)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO lookup (word, model, result, ts) VALUES (?,?,?,?)", rows)
+
+    def purge(self):
+        self._mem.clear()
+        with self._lock, self._conn: self._conn.execute("DELETE FROM lookup WHERE model != ''")
+
+    def info(self) -> Dict[str, Any]:
+        lookups = sum(self.stats.values())
+        hits = self.stats["mem_hits"] + self.stats["db_hits"]
+        with self._lock: entries = self._conn.execute("SELECT COUNT(*) FROM lookup").fetchone()[0]
+        return {**self.stats, "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+                "mem_entries": len(self._mem), "mem_limit": self.mem_items, "db_entries": entries}
+
+@metrics.stage("ocr_dhash")
+def dhash(image_bytes: bytes, size: int = OCR_DHASH_SIZE) -> int:
+    # 差值哈希：缩到 (size+1)xsize 灰度，逐行比较相邻像素明暗，对重新压缩、轻微缩放和裁边都不敏感
     img = Image.open(io.BytesIO(image_bytes))
-    img.thumbnail((1024, 1024))
+    img.draft("L", (size * 8, size * 8))
+    px = list(img.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = (bits << 1) | (px[row * (size + 1) + col] > px[row * (size + 1) + col + 1])
+    return bits
+
+@metrics.stage("ocr_signature")
+def ink_signature(image_bytes: bytes, size=OCR_SIGNATURE_SIZE) -> bytes:
+    # 裁到墨迹外框再缩到固定尺寸的灰度图，和位置、缩放无关；空白页返回空串
+    img = Image.open(io.BytesIO(image_bytes)).convert("L")
+    box = img.point(lambda p: 255 if p < 128 else 0).getbbox()
+    if not box: return b""
+    return img.crop(box).resize(size, Image.Resampling.BOX).tobytes()
+
+def signature_diff(a: bytes, b: bytes, size=OCR_SIGNATURE_SIZE) -> float:
+    # 两张缩略图按 8x8 小块求平均灰度差，返回最大的那块 (0~1)；局部换了一个字也能看出来
+    if len(a) != len(b): return 1.0
+    if not a: return 0.0
+    diff = ImageChops.difference(Image.frombytes("L", size, a), Image.frombytes("L", size, b))
+    return diff.resize((size[0] // 8, size[1] // 8), Image.Resampling.BOX).getextrema()[1] / 255
+
+def ocr_fingerprint(image_bytes: bytes):
+    return dhash(image_bytes), ink_signature(image_bytes)
+
+class OCRCache:
+    """OCR 结果缓存，按 (dHash, ocr_model) 做近似匹配，SQLite 持久化，超过条数上限时淘汰最久没用过的。
+
+    哈希全部常驻内存做线性比对 (几千个整数，异或 + popcount 只要几毫秒)；距离在阈值内的候选
+    再从库里取出墨迹缩略图逐个确认 (见 ink_signature)，确认通过才返回文字。
+    """
+    def __init__(self, path: str, max_entries: int, max_distance: int):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS ocr (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, phash TEXT NOT NULL, model TEXT NOT NULL, text TEXT NOT NULL, ts REAL NOT NULL, sig BLOB)""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_ts ON ocr (ts)")
+            # 旧库没有 sig 列：补上，旧条目 sig 为空，永远不会被确认命中，随淘汰自然消失
+            if "sig" not in [r[1] for r in self._conn.execute("PRAGMA table_info(ocr)")]:
+                self._conn.execute("ALTER TABLE ocr ADD COLUMN sig BLOB")
+            rows = self._conn.execute("SELECT id, phash, model FROM ocr").fetchall()
+        self._hashes: Dict[str, Dict[int, int]] = {}  # model -> {id: phash}
+        for row_id, phash, model in rows: self._hashes.setdefault(model, {})[row_id] = int(phash, 16)
+
+    def _candidates(self, phash: int, model: str) -> List[int]:
+        near = [((h ^ phash).bit_count(), row_id) for row_id, h in self._hashes.get(model, {}).items()]
+        return [row_id for d, row_id in sorted(near) if d <= self.max_distance]
+
+    def get(self, phash: int, sig: bytes, model: str) -> Optional[str]:
+        for row_id in self._candidates(phash, model):
+            with self._lock: row = self._conn.execute("SELECT text, sig FROM ocr WHERE id = ?", (row_id,)).fetchone()
+            if not row or row[1] is None or signature_diff(sig, row[1]) > OCR_SIGNATURE_MAX_BLOCK_DIFF: continue
+            with self._lock, self._conn: self._conn.execute("UPDATE ocr SET ts = ? WHERE id = ?", (time.time(), row_id))
+            self.stats["hits"] += 1
+            return row[0]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, phash: int, sig: bytes, model: str, text: str):
+        with self._lock, self._conn:
+            cur = self._conn.execute("INSERT INTO ocr (phash, model, text, ts, sig) VALUES (?,?,?,?,?)", (f"{phash:x}", model, text, time.time(), sig))
+            self._hashes.setdefault(model, {})[cur.lastrowid] = phash
+            over = self._conn.execute("SELECT COUNT(*) FROM ocr").fetchone()[0] - self.max_entries
+            if over > 0:
+                old = self._conn.execute("SELECT id, model FROM ocr ORDER BY ts LIMIT ?", (over,)).fetchall()
+                self._conn.executemany("DELETE FROM ocr WHERE id = ?", [(r[0],) for r in old])
+                for row_id, m in old: self._hashes.get(m, {}).pop(row_id, None)
+
+    def purge(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM ocr")
+            self._hashes.clear()
+
+    def info(self) -> Dict[str, Any]:
+        lookups = sum(self.stats.values())
+        return {**self.stats, "hit_ratio": round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                "entries": sum(len(v) for v in self._hashes.values()), "max_entries": self.max_entries, "max_distance": self.max_distance, "max_block_diff": OCR_SIGNATURE_MAX_BLOCK_DIFF}
+
+def make_vocab_store():
+    if VOCAB_BACKEND == "json": return JSONVocabStore(VOCAB_FILE)
+    store = SQLiteVocabStore(VOCAB_DB_FILE)
+    store.migrate_from_json(VOCAB_FILE)
+    return store
+
+vocab_store = make_vocab_store()
+lookup_cache = LookupCache(LOOKUP_CACHE_DB_FILE, LOOKUP_CACHE_MEM_ITEMS, LOOKUP_CACHE_TTL)
+lookup_cache.seed(vocab_store.list_all())
+ocr_cache = OCRCache(OCR_CACHE_DB_FILE, OCR_CACHE_MAX_ENTRIES, OCR_CACHE_MAX_DISTANCE)
+
+# 句末标点：拉丁/西里尔字母要求后面跟空白 (避开 3.14)，中日文标点直接断开；引号、括号跟着前一句走
+SENTENCE_BOUNDARY = re.compile(r'[.!?…]+["\'»”’)\]]*\s+|[。！？；]+[」』”’）]*\s*|\n\s*')
+# 句点前是这些常见缩写或单个大写字母 (人名首字母) 时不算句末，比如 e.g.、Dr.、т.е.、J. Smith
+ABBREVIATION_BEFORE_DOT = re.compile(r'(?:\b(?i:e\.g|i\.e|etc|vs|cf|approx|Mr|Mrs|Ms|Dr|Prof|St|No|т\.е|т\.д|т\.п|др|см|стр|г)|\b[A-ZА-ЯЁ])$')
+CLAUSE_BOUNDARY = re.compile(r'[,;:，、；：]\s*|\s+')
+
+def _hard_split(sentence: str, max_chars: int) -> List[str]:
+    # 超长句子在 max_chars 以内最后一个逗号/空白处断开，实在没有就硬切
+    parts = []
+    while len(sentence) > max_chars:
+        cut = 0
+        for m in CLAUSE_BOUNDARY.finditer(sentence, 0, max_chars):
+            cut = m.end()
+        if cut <= 0: cut = max_chars
+        parts.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence: parts.append(sentence)
+    return parts
+
+def split_sentences(text: str, min_chars: int = TTS_SEGMENT_MIN_CHARS, max_chars: int = TTS_SEGMENT_MAX_CHARS) -> List[str]:
+    sentences, start = [], 0
+    for m in SENTENCE_BOUNDARY.finditer(text):
+        if m.group().rstrip() == "." and ABBREVIATION_BEFORE_DOT.search(text, start, m.start()): continue
+        sentences.append(text[start:m.end()].strip())
+        start = m.end()
+    sentences.append(text[start:].strip())
+    # 太短的句子并到下一句里，减少上游调用次数；没有任何字母数字的片段 (纯标点) 不单独合成
+    segments, buf = [], ""
+    for sentence in sentences:
+        for piece in _hard_split(sentence, max_chars):
+            buf = f"{buf} {piece}".strip() if buf else piece
+            if len(buf) >= min_chars:
+                segments.append(buf)
+                buf = ""
+    if buf:
+        if segments and (len(segments[-1]) + len(buf) < max_chars or not re.search(r"\w", buf)): segments[-1] = f"{segments[-1]} {buf}"
+        else: segments.append(buf)
+    return [seg for seg in segments if re.search(r"\w", seg)]
+
+def _strip_id3(data: bytes, keep_head: bool, keep_tail: bool) -> bytes:
+    # 拼接 mp3 时去掉中间段的 ID3v2 头和 ID3v1 尾，只保留首段的头和末段的尾
+    if not keep_head and data[:3] == b"ID3" and len(data) >= 10:
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        data = data[10 + size + (10 if data[5] & 0x10 else 0):]
+    if not keep_tail and len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    return data
+
+@metrics.stage("mp3_join")
+def join_mp3_segments(segments: List[bytes]) -> bytes:
+    last = len(segments) - 1
+    return b"".join(_strip_id3(seg, i == 0, i == last) for i, seg in enumerate(segments))
+
+EXIF_ORIENTATION = 0x0112
+
+@metrics.stage("image_compress")
+def prepare_ocr_image(source: Union[bytes, BinaryIO]) -> bytes:
+    """把上传的图片整理成适合 OCR 的 JPEG：按 EXIF 摆正、缩到 OCR_MAX_SIDE 以内、(可选) 灰度 + 自动对比度
+
+    source 可以是 bytes，也可以是已 seek(0) 的二进制文件 (如上传暂存的临时文件)。
+    """
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    size = fp.seek(0, io.SEEK_END)
+    fp.seek(0)
+    img = Image.open(fp)
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    if img.format == "JPEG" and max(img.size) <= OCR_MAX_SIDE and orientation == 1 and size <= OCR_PASSTHROUGH_BYTES:
+        fp.seek(0)
+        return bytes(fp.read())
+    # JPEG 用 draft 在解码阶段按 1/2、1/4、1/8 缩小，大图省掉大部分解码和缩放开销
+    if img.format == "JPEG": img.draft("L" if OCR_GRAYSCALE else "RGB", (OCR_MAX_SIDE, OCR_MAX_SIDE))
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE))
+    if OCR_GRAYSCALE: img = ImageOps.autocontrast(ImageOps.grayscale(img), cutoff=1)
+    elif img.mode != "RGB": img = img.convert("RGB")
     buffered = io.BytesIO()
-    img.save(buffered, format="JPEG", quality=85)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+    img.save(buffered, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+    return buffered.getvalue()
+
+image_executor = ThreadPoolExecutor(max_workers=OCR_IMAGE_WORKERS, thread_name_prefix="ocr-image")
+
+async def prepare_ocr_image_async(source: Union[bytes, BinaryIO]) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(image_executor, prepare_ocr_image, source)
 
 # ================= 2. 核心逻辑 =================
 
+def detect_lang(text: str) -> str:
+    if re.search(r"[а-яА-ЯЁё]", text or ""): return "🇷🇺 俄语"
+    if re.search(r"[\u4e00-\u9fff]", text or ""): return "🇨🇳 中文"
+    return "🇬🇧 英语"
+
+def tts_lang_of(engine_type: str, voice_id: str, text: str) -> str:
+    # Edge 按音色反查语言，Google 的 voice_role 本身就是语言名，其余按文本猜
+    family = engine_family(engine_type)
+    if family == "Google" and voice_id in LANG_MAP_GOOGLE: return voice_id
+    if family == "Edge":
+        for lang, voices in VOICE_MAP_EDGE.items():
+            if any(v == voice_id for v, _ in voices): return lang
+    return detect_lang(text)
+
+def tts_engine_chain(engine_type: str, voice_id: str, text: str, api_key: Optional[str]):
+    """返回按尝试顺序排好的 [(engine, voice_role)]：用户选的引擎在前，其余按该语言的优先级链补上对应音色"""
+    lang = tts_lang_of(engine_type, voice_id, text)
+    chain = [(engine_type, voice_id)]
+    seen = {engine_family(engine_type)}
+    for family in TTS_FAILOVER_CHAINS.get(lang, ["Edge", "Google"]):
+        if family in seen: continue
+        seen.add(family)
+        if family == "Edge" and lang in VOICE_MAP_EDGE: chain.append(("Edge", VOICE_MAP_EDGE[lang][0][0]))
+        elif family == "SiliconFlow" and api_key: chain.append(("SiliconFlow", TTS_FAILOVER_SF_VOICE))
+        elif family == "Google" and lang in LANG_MAP_GOOGLE: chain.append(("Google", lang))
+    # 稳定排序：健康的引擎保持原顺序在前，最近老失败的放到最后兜底
+    return sorted(chain, key=lambda ev: not engine_health.healthy(engine_family(ev[0])))
+
+def engine_family(engine_type: str) -> str:
+    # 前端传的引擎名带说明文字 (如 "Edge (推荐)")，统一归一到引擎族
+    for name in ("Edge", "SiliconFlow", "Google"):
+        if name in (engine_type or ""): return name
+    return engine_type or ""
+
+class AudioCache:
+    """两级 TTS 音频缓存，按 (text, engine, voice_role, speed) 查找。
+
+    内存层是按字节限额的 LRU；磁盘层按内容哈希存 mp3 (同一段音频只存一份，也就是 GET /audio/{hash} 的文件)，
+    请求 key 到内容哈希的对应关系另存一个小的别名文件。磁盘层按最近访问顺序淘汰，命中会回填内存层。
+    别名和音频文件都在磁盘上，其他 worker 写入的条目在本进程未命中时也能查到。
+    所有方法都在事件循环里调用，文件读写丢给线程池。
+    """
+    def __init__(self, directory: str, mem_limit: int, disk_limit: int):
+        self.directory = directory
+        self.mem_limit = mem_limit
+        self.disk_limit = disk_limit
+        self._mem: "OrderedDict[str, bytes]" = OrderedDict()
+        self._mem_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()  # 内容哈希 -> 文件大小
+        self._disk_bytes = 0
+        self._alias: Dict[str, str] = {}  # 请求 key -> 内容哈希
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0}
+        self._scan_disk()
+
+    @staticmethod
+    def make_key(text: str, engine_type: str, voice_id: str, speed_int: int) -> str:
+        raw = json.dumps([text, engine_family(engine_type), voice_id, int(speed_int)], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], f"{digest}.mp3")
+
+    def _alias_path(self, key: str) -> str:
+        return os.path.join(self.directory, "keys", key[:2], key)
+
+    def _scan_disk(self):
+        # 启动时按 mtime 重建磁盘索引，最旧的排在最前面先被淘汰
+        entries = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    full = os.path.join(root, name)
+                    if os.path.basename(os.path.dirname(os.path.dirname(full))) == "keys":
+                        try:
+                            with open(full) as f: self._alias[name] = f.read().strip()
+                        except OSError: pass
+                        continue
+                    if not name.endswith(".mp3"): continue
+                    try: st = os.stat(full)
+                    except OSError: continue
+                    entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, digest, size in sorted(entries):
+            self._disk[digest] = size
+            self._disk_bytes += size
+
+    def _mem_put(self, key: str, data: bytes):
+        if len(data) > self.mem_limit: return
+        if key in self._mem: self._mem_bytes -= len(self._mem.pop(key))
+        self._mem[key] = data
+        self._mem_bytes += len(data)
+        while self._mem_bytes > self.mem_limit:
+            _, old = self._mem.popitem(last=False)
+            self._mem_bytes -= len(old)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, path)
+
+    def _disk_read(self, digest: str) -> bytes:
+        with open(self._path(digest), "rb") as f: return f.read()
+
+    def _disk_remove(self, digest: str):
+        try: os.remove(self._path(digest))
+        except OSError: pass
+
+    def _remove_alias(self, key: str):
+        try: os.remove(self._alias_path(key))
+        except OSError: pass
+
+    def _read_alias(self, key: str) -> Optional[str]:
+        try:
+            with open(self._alias_path(key)) as f: return f.read().strip() or None
+        except OSError: return None
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._mem.get(key)
+        if data is not None:
+            self._mem.move_to_end(key)
+            self.stats["mem_hits"] += 1
+            return data
+        # 本进程没见过的 key 再看一眼磁盘上的别名，可能是别的 worker 写的
+        digest = self._alias.get(key) or await asyncio.to_thread(self._read_alias, key)
+        if digest:
+            try:
+                data = await asyncio.to_thread(self._disk_read, digest)
+            except OSError:
+                # 音频已被淘汰，别名跟着删掉
+                self._disk_bytes -= self._disk.pop(digest, 0)
+                self._alias.pop(key, None)
+                await asyncio.to_thread(self._remove_alias, key)
+                data = None
+            if data is not None:
+                self._alias[key] = digest
+                if digest in self._disk: self._disk.move_to_end(digest)
+                self._mem_put(key, data)
+                self.stats["disk_hits"] += 1
+                return data
+        self.stats["misses"] += 1
+        return None
+
+    async def _store(self, data: bytes) -> Optional[str]:
+        # 按内容哈希写盘 (已存在就不再写)，返回哈希；写不了盘返回 None
+        digest = hashlib.sha256(data).hexdigest()
+        if digest in self._disk:
+            self._disk.move_to_end(digest)
+            return digest
+        if len(data) > self.disk_limit: return None
+        if not await asyncio.to_thread(os.path.isfile, self._path(digest)):
+            try: await asyncio.to_thread(self._write_atomic, self._path(digest), data)
+            except OSError: return None
+        if digest in self._disk: return digest  # 写盘期间同一段音频已被并发写入过
+        self._disk[digest] = len(data)
+        self._disk_bytes += len(data)
+        evicted = []
+        while self._disk_bytes > self.disk_limit:
+            old, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(old)
+        for old in evicted: await asyncio.to_thread(self._disk_remove, old)
+        return digest
+
+    async def put(self, key: str, data: bytes):
+        if not data: return
+        self._mem_put(key, data)
+        digest = await self._store(data)
+        if digest is None or self._alias.get(key) == digest: return
+        self._alias[key] = digest
+        try: await asyncio.to_thread(self._write_atomic, self._alias_path(key), digest.encode())
+        except OSError: pass
+
+    async def publish(self, data: bytes) -> str:
+        # 给 GET /audio/{hash} 用：已经按内容存过的不会再写；写盘失败时退回内存层，返回哈希
+        digest = await self._store(data)
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+            self._mem_put(digest, data)
+        return digest
+
+    def path_of(self, digest: str) -> Optional[str]:
+        # 路径由哈希直接算出，别的 worker 写的文件也能找到
+        path = self._path(digest)
+        if not os.path.isfile(path): return None
+        if digest in self._disk: self._disk.move_to_end(digest)
+        return path
+
+    async def purge(self, memory: bool = True, disk: bool = True):
+        if memory:
+            self._mem.clear()
+            self._mem_bytes = 0
+        if disk:
+            digests = list(self._disk)
+            self._disk.clear()
+            self._disk_bytes = 0
+            self._alias.clear()
+            for digest in digests: await asyncio.to_thread(self._disk_remove, digest)
+            await asyncio.to_thread(shutil.rmtree, os.path.join(self.directory, "keys"), True)
+
+    def info(self) -> Dict[str, Any]:
+        lookups = sum(self.stats.values())
+        hits = self.stats["mem_hits"] + self.stats["disk_hits"]
+        return {
+            **self.stats,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "mem_entries": len(self._mem), "mem_bytes": self._mem_bytes, "mem_limit": self.mem_limit,
+            "disk_entries": len(self._disk), "disk_bytes": self._disk_bytes, "disk_limit": self.disk_limit,
+            "aliases": len(self._alias),
+        }
+
+audio_cache = AudioCache(TTS_CACHE_DIR, TTS_CACHE_MEM_BYTES, TTS_CACHE_DISK_BYTES)
+
+class CircuitOpenError(Exception):
+    pass
+
+class RateLimitedError(Exception):
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """令牌桶 + 并发上限 + 先来先服务的等待队列。
+
+    只有队首的等待者能拿令牌，后来的请求不会插队；等待时间超过期限 (或明显等不到) 直接抛 RateLimitedError。
+    """
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.active = 0
+        self.blocked_until = 0.0
+        self.last_used = time.monotonic()
+        self._waiters: deque = deque()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, max_wait: float):
+        if len(self._waiters) >= QUOTA_MAX_QUEUE: raise RateLimitedError(f"{self.name}: too many queued requests")
+        deadline = time.monotonic() + max_wait
+        me = object()
+        self._waiters.append(me)
+        try:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                self.last_used = now
+                if self._waiters[0] is me and self.active < self.concurrency and now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.active += 1
+                    return
+                # 能算出来的等待 (暂停期、下一枚令牌) 超过期限就立刻拒绝，别白等
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+                if now + wait > deadline: raise RateLimitedError(f"{self.name}: rate limited", max(wait, 0.5))
+                await asyncio.sleep(min(max(wait, 0.01), 0.05))
+        finally:
+            self._waiters.remove(me)
+
+    def release(self, ok: bool = True):
+        self.active -= 1
+        if ok: self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+    def penalize(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.base_rate / 8, self.rate / 2)
+
+class QuotaManager:
+    """每次上游尝试先后拿 Key 级和上游级的名额；Key 级桶按最近使用淘汰，避免无限增长"""
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self.providers: Dict[str, TokenBucket] = {}
+        self.keys: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def _provider(self, provider: str) -> TokenBucket:
+        if provider not in self.providers:
+            self.providers[provider] = TokenBucket(provider, QUOTA_PROVIDER_RATE, QUOTA_PROVIDER_BURST, QUOTA_PROVIDER_CONCURRENCY)
+        return self.providers[provider]
+
+    def _key(self, provider: str, api_key: Optional[str]) -> Optional[TokenBucket]:
+        if not api_key: return None
+        ident = f"{provider}:{hashlib.sha256(api_key.encode()).hexdigest()[:16]}"
+        bucket = self.keys.get(ident)
+        if bucket is None:
+            bucket = self.keys[ident] = TokenBucket(f"key {ident[-6:]}", QUOTA_KEY_RATE, QUOTA_KEY_BURST, QUOTA_KEY_CONCURRENCY)
+            for old in [k for k, b in self.keys.items() if not b.active and not b._waiters][:max(0, len(self.keys) - self.max_keys)]:
+                del self.keys[old]
+        self.keys.move_to_end(ident)
+        return bucket
+
+    @asynccontextmanager
+    async def slot(self, provider: str, api_key: Optional[str] = None):
+        deadline = time.monotonic() + QUOTA_MAX_WAIT
+        buckets = [b for b in (self._key(provider, api_key), self._provider(provider)) if b]
+        taken = []
+        ok = False
+        try:
+            for bucket in buckets:
+                await bucket.acquire(max(0.0, deadline - time.monotonic()))
+                taken.append(bucket)
+            yield
+            ok = True
+        finally:
+            for bucket in taken: bucket.release(ok)
+
+    def penalize(self, provider: str, api_key: Optional[str], retry_after: Optional[float]):
+        bucket = self._key(provider, api_key) or self._provider(provider)
+        bucket.penalize(retry_after if retry_after is not None else QUOTA_DEFAULT_PENALTY)
+
+    def info(self) -> Dict[str, Any]:
+        return {"providers": {p: {"rate": round(b.rate, 2), "active": b.active, "queued": len(b._waiters),
+                                  "blocked_for": round(max(0.0, b.blocked_until - time.monotonic()), 1)} for p, b in self.providers.items()},
+                "keys": len(self.keys), "penalized_keys": sum(1 for b in self.keys.values() if b.blocked_until > time.monotonic())}
+
+quotas = QuotaManager()
+
+def retry_after_seconds(exc: BaseException) -> Optional[float]:
+    if not isinstance(exc, httpx.HTTPStatusError): return None
+    value = exc.response.headers.get("retry-after", "")
+    try: return float(value)
+    except ValueError: return None
+
+def is_retryable(exc: BaseException) -> bool:
+    # 网络/超时/5xx/429 值得重试，其他 4xx 和解析错误重试也没用；OSError 包括 ConnectionError (Edge 连接池断线)
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500 or exc.response.status_code == 429
+    return isinstance(exc, (OSError, httpx.TransportError, asyncio.TimeoutError, aiohttp.ClientError, gTTSError,
+                            edge_tts.exceptions.WebSocketError, edge_tts.exceptions.UnexpectedResponse))
+
+class CircuitBreaker:
+    """连续失败 failures 次后打开，cooldown 秒内直接拒绝；冷却后只放行一个探测请求，成功即恢复"""
+    def __init__(self, failures: int, cooldown: float):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None: return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        if self.opened_at is None: return True
+        if time.monotonic() - self.opened_at < self.cooldown or self.probing: return False
+        self.probing = True
+        return True
+
+    def record_success(self):
+        self.failures, self.opened_at, self.probing = 0, None, False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= self.threshold: self.opened_at = time.monotonic()
+
+class UpstreamGuard:
+    """包住所有上游调用的容错层，熔断按 provider (edge / google / SiliconFlow 的 host) 分别统计。
+
+    call(provider, fn) 里的 fn 是无参协程工厂，每次尝试 (包括对冲请求) 都会重新调用一次。
+    延迟按 (provider, kind) 分开统计，kind 由调用方给出 (调用类型 + 模型，或文本长度档位)，
+    避免 10 秒的 OCR 和 1 秒的查词共用一个 p95。对冲默认关闭，只给免费、幂等的调用 (Edge / gTTS) 打开，
+    按次计费的模型调用不对冲，免得重复扣费。
+    """
+    def __init__(self):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latencies: Dict[tuple, deque] = {}
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        if provider not in self.breakers: self.breakers[provider] = CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_COOLDOWN)
+        return self.breakers[provider]
+
+    def record_latency(self, provider: str, kind: str, seconds: float):
+        self.latencies.setdefault((provider, kind), deque(maxlen=200)).append(seconds)
+
+    def percentile(self, provider: str, kind: str, q: float) -> Optional[float]:
+        samples = self.latencies.get((provider, kind))
+        if not samples or len(samples) < UPSTREAM_HEDGE_MIN_SAMPLES: return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def _timed(self, provider, kind, fn, api_key=None):
+        # 每次尝试 (含对冲) 都要先拿配额；排队时间不计入延迟统计
+        async with quotas.slot(provider, api_key):
+            t0 = time.monotonic()
+            try: result = await fn()
+            except Exception as e:
+                status = str(e.response.status_code) if isinstance(e, httpx.HTTPStatusError) else "timeout" if isinstance(e, (httpx.TimeoutException, asyncio.TimeoutError)) else "error"
+                self._record(provider, status, time.monotonic() - t0)
+                raise
+            self.record_latency(provider, kind, time.monotonic() - t0)
+            self._record(provider, "ok", time.monotonic() - t0)
+            return result
+
+    @staticmethod
+    def _record(provider: str, status: str, seconds: float):
+        metrics.inc("upstream_requests_total", provider=provider, model=upstream_model.get(), status=status)
+        metrics.observe("upstream_request_duration_seconds", seconds, provider=provider, status=status)
+
+    async def _attempt(self, provider, kind, fn, hedge: bool, api_key=None):
+        delay = self.percentile(provider, kind, UPSTREAM_HEDGE_PERCENTILE) if hedge and UPSTREAM_HEDGE_PERCENTILE else None
+        if delay is None: return await self._timed(provider, kind, fn, api_key)
+        pending = {asyncio.create_task(self._timed(provider, kind, fn, api_key))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done: pending.add(asyncio.create_task(self._timed(provider, kind, fn, api_key)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None: return task.result()
+                    error = task.exception()
+                if not pending: raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending: task.cancel()
+
+    async def call(self, provider: str, fn, retries: int = UPSTREAM_RETRIES, hedge: bool = False, api_key: Optional[str] = None, kind: str = ""):
+        with metrics.stage("upstream_call"): return await self._call(provider, kind, fn, retries, hedge, api_key)
+
+    async def _call(self, provider, kind, fn, retries, hedge, api_key):
+        breaker = self.breaker(provider)
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                metrics.inc("upstream_requests_total", provider=provider, model=upstream_model.get(), status="circuit_open")
+                raise CircuitOpenError(f"{provider} temporarily unavailable (circuit open)")
+            try:
+                result = await self._attempt(provider, kind, fn, hedge, api_key)
+            except (asyncio.CancelledError, RateLimitedError):
+                # 本地配额拒绝不代表上游出问题，不计入熔断
+                breaker.probing = False
+                raise
+            except Exception as e:
+                throttled = isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429
+                if throttled: quotas.penalize(provider, api_key, retry_after_seconds(e))
+                # 只有上游正常回了 4xx 才说明它是活的 (429 只是这个 Key 被限流，不能让它把所有用户共用的熔断器打开)；
+                # 其余异常 (断线、超时、5xx、没收到音频、解析失败) 都算一次失败
+                if isinstance(e, httpx.HTTPStatusError) and 400 <= e.response.status_code < 500: breaker.record_success()
+                else: breaker.record_failure()
+                if (not is_retryable(e) and not throttled) or attempt >= retries: raise
+                backoff = random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt)))
+                retry_after = retry_after_seconds(e)
+                if retry_after is not None: backoff = max(backoff, min(retry_after, UPSTREAM_BACKOFF_MAX))
+                await asyncio.sleep(backoff)
+                continue
+            breaker.record_success()
+            return result
+
+    def info(self) -> Dict[str, Any]:
+        latency = lambda p, k: {"p50_ms": round((self.percentile(p, k, 0.5) or 0) * 1000, 1), "p95_ms": round((self.percentile(p, k, 0.95) or 0) * 1000, 1),
+                                "samples": len(self.latencies[(p, k)])}
+        return {p: {"state": b.state, "failures": b.failures, "latency": {k: latency(p, k) for (pp, k) in self.latencies if pp == p}}
+                for p, b in self.breakers.items()}
+
+def text_size_class(text: str) -> str:
+    # TTS 耗时随文本长度变化，按长度分档统计延迟，对冲阈值才有意义
+    return "short" if len(text) <= 40 else "medium" if len(text) <= 300 else "long"
+
+upstream = UpstreamGuard()
+
+class EngineHealth:
+    """按引擎记录最近 TTS_ENGINE_HEALTH_WINDOW 秒内真实上游合成的成败和耗时 (缓存命中不计)"""
+    def __init__(self):
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, engine: str, ok: bool, seconds: float):
+        self.samples.setdefault(engine, deque(maxlen=100)).append((time.monotonic(), ok, seconds))
+
+    def _recent(self, engine: str):
+        cutoff = time.monotonic() - TTS_ENGINE_HEALTH_WINDOW
+        return [x for x in self.samples.get(engine, ()) if x[0] >= cutoff]
+
+    def healthy(self, engine: str) -> bool:
+        if upstream.breaker(engine.lower() if engine != "SiliconFlow" else provider_for(None)).state == "open": return False
+        recent = self._recent(engine)
+        if len(recent) < TTS_ENGINE_MIN_SAMPLES: return True
+        return sum(1 for _, ok, _ in recent if not ok) / len(recent) <= TTS_ENGINE_MAX_FAILURE_RATE
+
+    def info(self) -> Dict[str, Any]:
+        out = {}
+        for engine in self.samples:
+            recent = self._recent(engine)
+            ok = [sec for _, good, sec in recent if good]
+            out[engine] = {"healthy": self.healthy(engine), "samples": len(recent),
+                           "failure_rate": round(1 - len(ok) / len(recent), 3) if recent else 0.0,
+                           "avg_ms": round(sum(ok) / len(ok) * 1000, 1) if ok else None}
+        return out
+
+engine_health = EngineHealth()
+
+class SingleFlight:
+    """合并同一时刻完全相同的上游请求：同 key 的并发调用共用一个任务，结果 (包括错误) 发给所有等待者。
+
+    任务用 shield 保护，某个等待者断开/取消不会连累其他人；任务结束即移除，不做缓存。
+    """
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def do(self, key: str, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self.stats["leaders"] += 1
+        else: self.stats["followers"] += 1
+        return await asyncio.shield(task)
+
+    def info(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._inflight)}
+
+singleflight = SingleFlight()
+
+def flight_key(*parts) -> str:
+    # bytes (如图片) 先取哈希；调用方把 API Key 的哈希也放进来，不同用户的 Key 不会共用一次调用的计费和报错
+    raw = json.dumps([p if isinstance(p, (str, int, float, type(None), list, dict)) else hashlib.sha256(p).hexdigest() for p in parts], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def provider_for(base_url: Optional[str]) -> str:
+    return httpx.URL(base_url or DEFAULT_BASE_URL).host
+
+class HTTPClientRegistry:
+    """按 base_url 复用的 httpx.AsyncClient，省掉每次请求的 TCP+TLS 握手。
+
+    客户端第一次用到时才创建，随 FastAPI lifespan 一起关闭。默认地址和配置过的地址常驻，
+    客户端自带的 base_url 按 LRU 最多留 max_clients 个，淘汰的延迟 close_delay 秒关闭。
+    """
+    def __init__(self, default_limits: Dict[str, Any], limits_by_url: Dict[str, Dict[str, Any]], max_clients: int, close_delay: float):
+        self.default_limits = default_limits
+        self.limits_by_url = {k.rstrip("/"): v for k, v in limits_by_url.items()}
+        self.max_clients = max_clients
+        self.close_delay = close_delay
+        self._pinned: Dict[str, httpx.AsyncClient] = {}
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+        self._retired: Set[httpx.AsyncClient] = set()
+
+    def get(self, base_url: Optional[str] = None) -> httpx.AsyncClient:
+        url = (base_url or DEFAULT_BASE_URL).rstrip("/")
+        clients = self._pinned if url == DEFAULT_BASE_URL.rstrip("/") or url in self.limits_by_url else self._clients
+        client = clients.get(url)
+        if client is None or client.is_closed:
+            limits = {**self.default_limits, **self.limits_by_url.get(url, {})}
+            client = httpx.AsyncClient(base_url=url, http2=HTTP2_AVAILABLE, limits=httpx.Limits(**limits))
+            clients[url] = client
+        if clients is self._clients:
+            self._clients.move_to_end(url)
+            while len(self._clients) > self.max_clients: self._retire(self._clients.popitem(last=False)[1])
+        return client
+
+    def _retire(self, client: httpx.AsyncClient):
+        async def close_later():
+            await asyncio.sleep(self.close_delay)
+            if client in self._retired:
+                self._retired.discard(client)
+                await client.aclose()
+        self._retired.add(client)
+        asyncio.get_running_loop().create_task(close_later())
+
+    def info(self) -> Dict[str, Any]:
+        return {"pinned": len(self._pinned), "clients": len(self._clients), "max_clients": self.max_clients, "retired": len(self._retired)}
+
+    async def aclose(self):
+        clients = list(self._pinned.values()) + list(self._clients.values()) + list(self._retired)
+        self._pinned, self._clients, self._retired = {}, OrderedDict(), set()
+        for client in clients: await client.aclose()
+
+http_clients = HTTPClientRegistry(HTTP_POOL_LIMITS, HTTP_POOL_LIMITS_BY_URL, HTTP_CLIENTS_MAX, HTTP_CLIENT_CLOSE_DELAY)
+
+class EdgeConnection:
+    def __init__(self, ws):
+        self.ws = ws
+        self.created = self.last_used = time.monotonic()
+
+class EdgeSessionPool:
+    """Edge 朗读服务的 WebSocket 连接池。
+
+    同一条连接上可以连续发多轮 SSML (每轮以 turn.end 结束)，所以合成完把连接放回池里，下次直接发请求。
+    取出时丢掉已关闭、空闲太久或太老的连接；复用的连接在出声前就失败 (服务端悄悄断开) 时换新连接重试一次。
+    后台任务定期 ping 空闲连接，并在最近有请求时保持 EDGE_POOL_MIN_IDLE 条预热连接。
+    """
+    def __init__(self, size: int, min_idle: int):
+        self.size = size
+        self.min_idle = min_idle
+        self._idle: deque = deque()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._ssl = ssl.create_default_context(cafile=certifi.where()) if EDGE_POOL_AVAILABLE else None
+        self._task: Optional[asyncio.Task] = None
+        self._last_request = 0.0
+        self.stats = {"opened": 0, "reused": 0, "retried": 0, "discarded": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return EDGE_POOL_AVAILABLE and self.size > 0
+
+    def start(self):
+        if self.enabled and self._task is None: self._task = asyncio.create_task(self._maintain())
+
+    async def aclose(self):
+        if self._task: self._task.cancel()
+        self._task = None
+        while self._idle: await self._idle.pop().ws.close()
+        if self._session: await self._session.close()
+        self._session = None
+
+    def _healthy(self, conn: EdgeConnection) -> bool:
+        now = time.monotonic()
+        return not conn.ws.closed and now - conn.last_used < EDGE_POOL_IDLE_TIMEOUT and now - conn.created < EDGE_POOL_MAX_AGE
+
+    def _drop(self, conn: EdgeConnection):
+        self.stats["discarded"] += 1
+        asyncio.ensure_future(conn.ws.close())
+
+    async def _open(self) -> EdgeConnection:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(trust_env=True, timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60))
+        for attempt in range(2):
+            try:
+                ws = await self._session.ws_connect(
+                    f"{WSS_URL}&ConnectionId={connect_id()}&Sec-MS-GEC={DRM.generate_sec_ms_gec()}&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}",
+                    compress=15, headers=DRM.headers_with_muid(WSS_HEADERS), ssl=self._ssl)
+                break
+            except aiohttp.ClientResponseError as e:
+                if e.status != 403 or attempt: raise
+                DRM.handle_client_response_error(e)  # 本机时钟偏差导致的 403，校正后重连一次
+        # 输出格式是连接级配置，每条连接只发一次
+        await ws.send_str(f"X-Timestamp:{date_to_string()}\r\nContent-Type:application/json; charset=utf-8\r\nPath:speech.config\r\n\r\n"
+                          '{"context":{"synthesis":{"audio":{"metadataoptions":{"sentenceBoundaryEnabled":"false","wordBoundaryEnabled":"false"},'
+                          '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n')
+        self.stats["opened"] += 1
+        return EdgeConnection(ws)
+
+    async def _acquire(self):
+        while self._idle:
+            conn = self._idle.pop()  # 后进先出：最近用过的连接最可能还活着
+            if self._healthy(conn):
+                self.stats["reused"] += 1
+                return conn, True
+            self._drop(conn)
+        return await self._open(), False
+
+    def _release(self, conn: EdgeConnection):
+        conn.last_used = time.monotonic()
+        if len(self._idle) < self.size and self._healthy(conn): self._idle.append(conn)
+        else: self._drop(conn)
+
+    @staticmethod
+    async def _turn(ws, tts_config, escaped_text):
+        await ws.send_str(ssml_headers_plus_data(connect_id(), date_to_string(), mkssml(tts_config, escaped_text)))
+        while True:
+            msg = await ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                data = msg.data.encode("utf-8")
+                headers, _ = get_headers_and_data(data, data.find(b"\r\n\r\n"))
+                if headers.get(b"Path") == b"turn.end": return
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                if len(msg.data) < 2: raise ValueError("Malformed Edge audio frame")
+                headers, audio = get_headers_and_data(msg.data, int.from_bytes(msg.data[:2], "big"))
+                if headers.get(b"Path") == b"audio" and headers.get(b"Content-Type") == b"audio/mpeg" and audio: yield audio
+            else: raise ConnectionError(f"Edge connection closed ({msg.type.name})")
+
+    async def stream(self, text: str, voice: str, rate: str = "+0%"):
+        self._last_request = time.monotonic()
+        tts_config = TTSConfig(voice, rate, "+0%", "+0Hz", "SentenceBoundary")
+        for part in split_text_by_byte_length(xml_escape(remove_incompatible_characters(text)), 4096):
+            got_audio = False
+            for attempt in range(2):
+                conn, reused = await self._acquire()
+                try:
+                    async for audio in self._turn(conn.ws, tts_config, part):
+                        got_audio = True
+                        yield audio
+                except Exception:
+                    self._drop(conn)
+                    if reused and not got_audio and attempt == 0:
+                        self.stats["retried"] += 1
+                        continue
+                    raise
+                except BaseException:
+                    self._drop(conn)  # 调用方中途取消/断开：这条连接的这一轮没读完，不能再复用
+                    raise
+                self._release(conn)
+                break
+            if not got_audio: raise ValueError("No audio was received from Edge")
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(EDGE_POOL_CHECK_INTERVAL)
+            for conn in list(self._idle):
+                if self._healthy(conn):
+                    try: await conn.ws.ping()
+                    except Exception: pass
+                    else: continue
+                if conn in self._idle: self._idle.remove(conn)
+                self._drop(conn)
+            if time.monotonic() - self._last_request > EDGE_POOL_WARM_WINDOW: continue
+            try:
+                while len(self._idle) < min(self.min_idle, self.size): self._idle.append(await self._open())
+            except Exception: pass
+
+    def info(self) -> Dict[str, Any]:
+        return {**self.stats, "enabled": self.enabled, "idle": len(self._idle), "size": self.size}
+
+edge_pool = EdgeSessionPool(EDGE_POOL_SIZE, EDGE_POOL_MIN_IDLE)
+
+async def edge_stream(text: str, voice_id: str, speed_int: int):
+    # 有连接池就走连接池，否则按 edge_tts 的默认方式每次新建连接
+    if edge_pool.enabled:
+        async for audio in edge_pool.stream(text, voice_id, f"{speed_int:+d}%"): yield audio
+        return
+    communicate = edge_tts.Communicate(text, voice_id, rate=f"{speed_int:+d}%")
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio": yield chunk["data"]
+
+gtts_executor = ThreadPoolExecutor(max_workers=GTTS_WORKERS, thread_name_prefix="gtts")
+
+def _gtts_fetch(part: str, lang: str) -> bytes:
+    # part 已经是 gTTS 自己切好的一片，关掉预处理和再切分，保证一片只发一个请求
+    return b"".join(gTTS(text=part, lang=lang, pre_processor_funcs=[], tokenizer_func=lambda t: [t]).stream())
+
+async def gtts_synthesize(text: str, lang: str) -> bytes:
+    # 用 gTTS 私有的 _tokenize 按它自己的规则切片 (requirements.txt 里把 gtts 锁在 2.5.x)
+    parts = gTTS(text=text, lang=lang)._tokenize(text)
+    if not parts: raise ValueError("No text to speak")
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(GTTS_CHUNK_CONCURRENCY)
+    async def fetch(part):
+        async with sem: return await loop.run_in_executor(gtts_executor, _gtts_fetch, part, lang)
+    # 各片都是独立的 mp3 帧序列，按原顺序直接拼接即可 (gTTS 自己的 write_to_fp 也是这么做的)
+    return b"".join(await asyncio.gather(*(fetch(p) for p in parts)))
+
 async def get_audio_bytes_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url=None):
+    # Edge/Google 不用 API Key，所有人的相同请求都能合并；SiliconFlow 只合并同一个 Key 的请求
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest() if api_key and engine_family(engine_type) == "SiliconFlow" else None
+    key = flight_key("tts", text, engine_family(engine_type), voice_id, int(speed_int), key_hash, base_url)
+    return await singleflight.do(key, lambda: _get_audio_bytes_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url))
+
+async def _get_audio_bytes_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url=None):
+    # 每个分支的 synth() 是一次完整的上游尝试，重试/对冲/熔断交给 upstream.call
     if "Edge" in engine_type:
-        try:
-            communicate = edge_tts.Communicate(text, voice_id, rate=f"{speed_int:+d}%")
+        async def synth():
             mp3_fp = io.BytesIO()
-            async for chunk in communicate.stream():
-                if chunk["type"] == "audio": mp3_fp.write(chunk["data"])
-            return mp3_fp.getvalue(), None
+            async for audio in edge_stream(text, voice_id, speed_int): mp3_fp.write(audio)
+            return mp3_fp.getvalue()
+        try: return await upstream.call("edge", synth, hedge=True, kind=f"tts:{text_size_class(text)}"), None
+        except RateLimitedError: raise
         except Exception as e: return None, f"Edge Error: {e}"
     elif "SiliconFlow" in engine_type:
         if not api_key: return None, "Need API Key"
         url = base_url or DEFAULT_BASE_URL
         headers = {"Authorization": f"Bearer {api_key}"}
         model_id = voice_id.split(":")[0] if ":" in voice_id else "FunAudioLLM/CosyVoice2-0.5B"
-        try:
-            async with httpx.AsyncClient() as client:
-                res = await client.post(f"{url}/audio/speech", headers=headers, json={"model": model_id, "voice": voice_id, "input": text, "speed": 1.0 + (speed_int/100.0)}, timeout=30.0)
-                res.raise_for_status()
-                return res.content, None
+        async def synth():
+            res = await http_clients.get(url).post("/audio/speech", headers=headers, json={"model": model_id, "voice": voice_id, "input": text, "speed": 1.0 + (speed_int/100.0)}, timeout=30.0)
+            res.raise_for_status()
+            return res.content
+        upstream_model.set(model_id)
+        try: return await upstream.call(provider_for(url), synth, api_key=api_key, kind=f"tts:{model_id}"), None
+        except RateLimitedError: raise
         except Exception as e: return None, str(e)
     elif "Google" in engine_type:
-        try:
-            tts = gTTS(text=text, lang=LANG_MAP_GOOGLE.get(voice_id, "en"))
-            mp3_fp = io.BytesIO()
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, tts.write_to_fp, mp3_fp)
-            return mp3_fp.getvalue(), None
+        async def synth(): return await gtts_synthesize(text, LANG_MAP_GOOGLE.get(voice_id, "en"))
+        try: return await upstream.call("google", synth, hedge=True, kind=f"tts:{text_size_class(text)}"), None
+        except RateLimitedError: raise
         except Exception as e: return None, str(e)
     return None, "Unknown Engine"
 
+async def stream_audio_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url=None):
+    # 边合成边产出音频块，出错直接抛异常；Google 引擎不支持流式，整段合成后一次产出
+    # 推流期间一直占着配额里的并发名额
+    if "Edge" in engine_type:
+        async with quotas.slot("edge"):
+            async for audio in edge_stream(text, voice_id, speed_int): yield audio
+    elif "SiliconFlow" in engine_type:
+        if not api_key: raise ValueError("Need API Key")
+        headers = {"Authorization": f"Bearer {api_key}"}
+        model_id = voice_id.split(":")[0] if ":" in voice_id else "FunAudioLLM/CosyVoice2-0.5B"
+        payload = {"model": model_id, "voice": voice_id, "input": text, "speed": 1.0 + (speed_int/100.0)}
+        async with quotas.slot(provider_for(base_url), api_key):
+            async with http_clients.get(base_url).stream("POST", "/audio/speech", headers=headers, json=payload, timeout=30.0) as res:
+                metrics.inc("upstream_requests_total", provider=provider_for(base_url), model=model_id, status=str(res.status_code))
+                if res.status_code == 429: quotas.penalize(provider_for(base_url), api_key, retry_after_seconds(httpx.HTTPStatusError("429", request=res.request, response=res)))
+                res.raise_for_status()
+                async for part in res.aiter_bytes(): yield part
+    elif "Google" in engine_type:
+        b, e = await get_audio_bytes_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url)
+        if e: raise RuntimeError(e)
+        yield b
+    else: raise ValueError("Unknown Engine")
+
+async def get_audio_cached_async(text, engine_type, voice_id, speed_int, api_key, base_url=None):
+    key = AudioCache.make_key(text, engine_type, voice_id, speed_int)
+    cached = await audio_cache.get(key)
+    if cached is not None: return cached, None
+    t0 = time.monotonic()
+    b, e = await get_audio_bytes_mixed_async(text, engine_type, voice_id, speed_int, api_key, base_url)
+    engine_health.record(engine_family(engine_type), bool(b) and not e, time.monotonic() - t0)
+    if b: await audio_cache.put(key, b)
+    return b, e
+
+async def get_audio_failover_async(text, engine_type, voice_id, speed_int, api_key, base_url=None, synth=None):
+    # 依次尝试 tts_engine_chain 里的引擎，返回 (音频, 错误, 实际使用的引擎)
+    synth = synth or get_audio_cached_async
+    errors = []
+    for engine, voice in tts_engine_chain(engine_type, voice_id, text, api_key):
+        b, e = await synth(text, engine, voice, speed_int, api_key, base_url)
+        if b and not e: return b, None, engine_family(engine)
+        errors.append(f"{engine_family(engine)}: {e or 'Empty Audio'}")
+    return None, "; ".join(errors), None
+
+def parse_lookup_batch(content: str) -> Dict[str, Any]:
+    # 模型不一定照格式返回 (比如 {"results": [...]} 或干脆是数组)，形状不对就整批报错，由调用方逐词记为失败
+    data = json.loads(content)
+    results = data.get("results") if isinstance(data, dict) else None
+    if not isinstance(results, dict): raise ValueError(f"Unexpected lookup_batch response shape: {type(results if isinstance(data, dict) else data).__name__}")
+    return results
+
 async def ai_api_call_async(type, api_key, content=None, image_bytes=None, chat_model=None, ocr_model=None, base_url=None):
+    key = flight_key("ai", type, hashlib.sha256((api_key or "").encode()).hexdigest(), content, image_bytes, chat_model, ocr_model, base_url)
+    return await singleflight.do(key, lambda: _ai_api_call_async(type, api_key, content, image_bytes, chat_model, ocr_model, base_url))
+
+async def _ai_api_call_async(type, api_key, content=None, image_bytes=None, chat_model=None, ocr_model=None, base_url=None):
     if not api_key: return None, "Need API Key"
     url = base_url or DEFAULT_BASE_URL
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     
-    if not chat_model: chat_model = "deepseek-ai/DeepSeek-V3"
-    if not ocr_model: ocr_model = "Qwen/Qwen2.5-VL-72B-Instruct"
+    if not chat_model: chat_model = DEFAULT_CHAT_MODEL
+    if not ocr_model: ocr_model = DEFAULT_OCR_MODEL
 
-    try:
-        async with httpx.AsyncClient(base_url=url) as client:
-            if type == "ocr" and image_bytes:
-                b64 = compress_image(image_bytes)
-                payload = {"model": ocr_model, "messages": [{"role": "user", "content": [{"type": "text", "text": "OCR text only. Keep formatting."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}]}]}
-                res = await client.post("/chat/completions", headers=headers, json=payload, timeout=60.0)
-                res.raise_for_status()
-                return res.json()['choices'][0]['message']['content'], None
-            elif type == "lookup" and content:
-                prompt = f"""Dictionary API. User input: "{content}". Return JSON: {{ "lang": "...", "ipa": "...", "zh": "...", "ru": "..." }} (lang example: "🇬🇧 英语", "🇷🇺 俄语")"""
-                payload = {"model": chat_model, "messages": [{"role": "user", "content": prompt}], "response_format": {"type": "json_object"}}
-                res = await client.post("/chat/completions", headers=headers, json=payload, timeout=30.0)
-                res.raise_for_status()
-                return json.loads(res.json()['choices'][0]['message']['content']), None
-            elif type == "trans" and content:
-                res = await client.post("/chat/completions", headers=headers, json={
-                    "model": chat_model,
-                    "messages": [{"role": "user", "content": f"Translate the following text to Chinese (keep it natural and concise):\n\n{content}"}]
-                }, timeout=30.0)
-                res.raise_for_status()
-                return res.json()['choices'][0]['message']['content'], None
+    # 先按类型组好请求和结果解析方式，真正的上游调用统一交给 upstream.call (重试/对冲/熔断)
+    if type == "ocr" and image_bytes:
+        # image_bytes 需已经过 prepare_ocr_image 预处理 (见 ocr_image_async)
+        with metrics.stage("base64_encode"): b64 = base64.b64encode(image_bytes).decode('utf-8')
+        payload = {"model": ocr_model, "messages": [{"role": "user", "content": [{"type": "text", "text": "OCR text only. Keep formatting."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}]}]}
+        timeout, parse = 60.0, lambda c: c
+    elif type == "lookup" and content:
+        prompt = f"""Dictionary API. User input: "{content}". Return JSON: {{ "lang": "...", "ipa": "...", "zh": "...", "ru": "..." }} (lang example: "🇬🇧 英语", "🇷🇺 俄语")"""
+        payload = {"model": chat_model, "messages": [{"role": "user", "content": prompt}], "response_format": {"type": "json_object"}}
+        timeout, parse = 30.0, json.loads
+    elif type == "lookup_batch" and content:
+        words = json.dumps(content, ensure_ascii=False)
+        prompt = f"""Dictionary API. User input is a JSON array of words: {words}. Return JSON: {{ "results": {{ "<word exactly as given>": {{ "lang": "...", "ipa": "...", "zh": "...", "ru": "..." }} }} }} with one entry per input word (lang example: "🇬🇧 英语", "🇷🇺 俄语")"""
+        payload = {"model": chat_model, "messages": [{"role": "user", "content": prompt}], "response_format": {"type": "json_object"}}
+        timeout, parse = 60.0, parse_lookup_batch
+    elif type == "trans" and content:
+        payload = {
+            "model": chat_model,
+            "messages": [{"role": "user", "content": f"Translate the following text to Chinese (keep it natural and concise):\n\n{content}"}]
+        }
+        timeout, parse = 30.0, lambda c: c
+    else: return None, None
+
+    async def post():
+        res = await http_clients.get(url).post("/chat/completions", headers=headers, json=payload, timeout=timeout)
+        res.raise_for_status()
+        return parse(res.json()['choices'][0]['message']['content'])
+    upstream_model.set(payload["model"])
+    try: return await upstream.call(provider_for(url), post, api_key=api_key, kind=f"{type}:{payload['model']}"), None
+    except RateLimitedError: raise
     except Exception as e: return None, str(e)
 
+async def get_audio_segmented_async(text, engine_type, voice_id, speed_int, api_key, base_url=None):
+    segments = split_sentences(text)
+    if len(segments) <= 1: return await get_audio_cached_async(text, engine_type, voice_id, speed_int, api_key, base_url)
+    sem = asyncio.Semaphore(TTS_SEGMENT_CONCURRENCY)
+    async def synth_one(segment):
+        async with sem: return await get_audio_cached_async(segment, engine_type, voice_id, speed_int, api_key, base_url)
+    results = await asyncio.gather(*(synth_one(seg) for seg in segments))
+    for b, e in results:
+        if e or not b: return None, e or "Empty Audio"
+    return join_mp3_segments([b for b, _ in results]), None
+
+async def lookup_cached_async(word, api_key, chat_model=None, base_url=None):
+    model = chat_model or DEFAULT_CHAT_MODEL
+    cached = lookup_cache.get(word, model)
+    if cached is not None: return cached, None
+    info, e = await ai_api_call_async("lookup", api_key, content=word, chat_model=model, base_url=base_url)
+    if info and not e: lookup_cache.put(word, model, info)
+    return info, e
+
+def estimate_tokens(text: str) -> int:
+    # 粗估：拉丁字母约 4 字符 1 token，中日文约 1 字 1 token
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+def pack_lookup_batches(words: List[str]) -> List[List[str]]:
+    batches, cur, budget = [], [], 0
+    for w in words:
+        cost = estimate_tokens(w) + LOOKUP_BATCH_TOKENS_PER_RESULT
+        if cur and (len(cur) >= LOOKUP_BATCH_MAX_WORDS or budget + cost > LOOKUP_BATCH_TOKEN_BUDGET):
+            batches.append(cur)
+            cur, budget = [], 0
+        cur.append(w)
+        budget += cost
+    if cur: batches.append(cur)
+    return batches
+
+async def lookup_batch_async(words: List[str], api_key, chat_model=None, base_url=None) -> List[Dict[str, Any]]:
+    # 先查缓存，未命中的按 token 预算打包成少量 JSON 补全；结果按输入顺序逐词返回，单词级别报错
+    model = chat_model or DEFAULT_CHAT_MODEL
+    results: Dict[str, Dict[str, Any]] = {}
+    misses = []
+    for w in dict.fromkeys(w.strip() for w in words if w and w.strip()):
+        cached = lookup_cache.get(w, model)
+        if cached is not None: results[w] = {"word": w, "result": cached, "error": None, "cached": True}
+        else: misses.append(w)
+
+    sem = asyncio.Semaphore(LOOKUP_BATCH_CONCURRENCY)
+    async def run_batch(batch):
+        async with sem:
+            try: found, e = await ai_api_call_async("lookup_batch", api_key, content=batch, chat_model=model, base_url=base_url)
+            except RateLimitedError as ex: found, e = None, str(ex)
+        # 模型返回的键大小写可能和输入不一致，按规范化形式对回去
+        by_norm = {normalize_word(k): v for k, v in (found or {}).items() if isinstance(v, dict)}
+        for w in batch:
+            info = by_norm.get(normalize_word(w))
+            if info:
+                lookup_cache.put(w, model, info)
+                results[w] = {"word": w, "result": info, "error": None, "cached": False}
+            else: results[w] = {"word": w, "result": None, "error": e or "Missing in model response", "cached": False}
+    await asyncio.gather(*(run_batch(b) for b in pack_lookup_batches(misses)))
+    return [results[w] for w in dict.fromkeys(w.strip() for w in words if w and w.strip())]
+
+def split_paragraphs(text: str, max_chars: int = TRANSLATE_PARAGRAPH_MAX_CHARS) -> List[List[str]]:
+    # 每个原文段落一个列表；超长段落按句子切成几块分别翻译，译文只在段内拼回去，不会凭空多出段落
+    paragraphs = []
+    for para in re.split(r"\n\s*\n", text or ""):
+        para = para.strip()
+        if not para: continue
+        if len(para) <= max_chars: paragraphs.append([para])
+        else: paragraphs.append(split_sentences(para, min_chars=max_chars // 2, max_chars=max_chars))
+    return paragraphs
+
+CJK_EDGE = r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]"
+
+def join_chunks(chunks: List[str]) -> str:
+    # 同一段的几块译文拼回一段：挨着中文 (含全角标点) 的直接相连，其他情况补一个空格
+    out = ""
+    for chunk in chunks:
+        if out and not (re.search(CJK_EDGE + "$", out) or re.match(CJK_EDGE, chunk)): out += " "
+        out += chunk
+    return out
+
+translate_cache: "OrderedDict[str, str]" = OrderedDict()
+
+async def translate_paragraph_async(paragraph, api_key, chat_model=None, base_url=None):
+    model = chat_model or DEFAULT_CHAT_MODEL
+    key = hashlib.sha256(f"{model}\n{paragraph}".encode("utf-8")).hexdigest()
+    if key in translate_cache:
+        translate_cache.move_to_end(key)
+        return translate_cache[key], None
+    t, e = await ai_api_call_async("trans", api_key, content=paragraph, chat_model=model, base_url=base_url)
+    if t and not e:
+        translate_cache[key] = t
+        while len(translate_cache) > TRANSLATE_CACHE_ITEMS: translate_cache.popitem(last=False)
+    return t, e
+
+def translate_paragraph_tasks(text, api_key, chat_model=None, base_url=None) -> List[List[asyncio.Task]]:
+    # 所有段落 (的每一块) 同时起任务，信号量限制同时在途的上游请求数；外层列表按原文段落顺序，交给 await_paragraph 逐段取结果
+    sem = asyncio.Semaphore(TRANSLATE_CONCURRENCY)
+    async def run(chunk):
+        async with sem: return await translate_paragraph_async(chunk, api_key, chat_model, base_url)
+    return [[asyncio.create_task(run(c)) for c in chunks] for chunks in split_paragraphs(text)]
+
+async def await_paragraph(tasks: List[asyncio.Task]):
+    # 等一个段落的所有块，返回 (拼好的译文, 第一个错误)；RateLimitedError 原样抛出
+    results = [await task for task in tasks]
+    for _, e in results:
+        if e: return None, e
+    return join_chunks([t for t, _ in results]), None
+
+async def ocr_prepared_async(prepared: bytes, api_key, ocr_model=None, base_url=None):
+    # prepared 是 prepare_ocr_image 的输出；相似页命中 OCR 缓存时不调用模型
+    model = ocr_model or DEFAULT_OCR_MODEL
+    try: phash, sig = await asyncio.get_running_loop().run_in_executor(image_executor, ocr_fingerprint, prepared)
+    except Exception: phash = sig = None
+    if phash is not None:
+        cached = ocr_cache.get(phash, sig, model)
+        if cached is not None: return cached, None
+    t, e = await ai_api_call_async("ocr", api_key, image_bytes=prepared, ocr_model=model, base_url=base_url)
+    if t and not e and phash is not None: ocr_cache.put(phash, sig, model, t)
+    return t, e
+
+async def ocr_image_async(source, api_key, ocr_model=None, base_url=None):
+    try: prepared = await prepare_ocr_image_async(source)
+    except Exception: return None, "Invalid Image"
+    return await ocr_prepared_async(prepared, api_key, ocr_model, base_url)
+
+# pdfium 不是线程安全的 (不同文档也不行)，所有 PDF 渲染都放进这个单线程池串行执行
+pdf_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-render")
+
+@metrics.stage("pdf_render")
+def render_pdf_pages(pdf_bytes: bytes, max_pages: int) -> Tuple[List[bytes], int]:
+    # 每页按长边 OCR_MAX_SIDE 渲染成 JPEG，后面照常走 prepare_ocr_image；只能在 pdf_executor 里调用
+    # 返回 (页图片列表, 总页数)；总页数超过 max_pages 时一页都不渲染，由调用方整体拒绝，不悄悄截断
+    pages = []
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        if len(pdf) > max_pages: return [], len(pdf)
+        for i in range(len(pdf)):
+            page = pdf[i]
+            scale = OCR_MAX_SIDE / max(page.get_size())
+            buffered = io.BytesIO()
+            page.render(scale=scale).to_pil().convert("RGB").save(buffered, format="JPEG", quality=OCR_JPEG_QUALITY)
+            pages.append(buffered.getvalue())
+    finally: pdf.close()
+    return pages, len(pages)
+
+async def ocr_batch_async(pages: List[Dict[str, Any]], api_key, ocr_model=None, base_url=None) -> List[Dict[str, Any]]:
+    """pages: [{"source": 文件名, "page": 页码, "data": 图片字节}]，按顺序返回每页文字和耗时。
+
+    内容相同的页只识别一次 (duplicate_of 指向第一次出现的页)；预处理在图片线程池里并行，
+    视觉模型调用受 OCR_BATCH_CONCURRENCY 并发和 OCR_BATCH_MIN_INTERVAL 发送间隔限制。
+    """
+    sem = asyncio.Semaphore(OCR_BATCH_CONCURRENCY)
+    pacing = {"next": 0.0}
+    loop = asyncio.get_running_loop()
+
+    async def run(page):
+        result = {"text": None, "error": None, "timings": {}}
+        t0 = time.perf_counter()
+        try: prepared = await prepare_ocr_image_async(page["data"])
+        except Exception:
+            result["error"] = "Invalid Image"
+            return result
+        result["timings"]["preprocess_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        async with sem:
+            now = loop.time()
+            wait = pacing["next"] - now
+            pacing["next"] = max(now, pacing["next"]) + OCR_BATCH_MIN_INTERVAL
+            if wait > 0: await asyncio.sleep(wait)
+            t1 = time.perf_counter()
+            try: result["text"], result["error"] = await ocr_prepared_async(prepared, api_key, ocr_model, base_url)
+            except RateLimitedError as e: result["error"] = str(e)
+            result["timings"]["ocr_ms"] = round((time.perf_counter() - t1) * 1000, 1)
+        return result
+
+    first_seen: Dict[str, int] = {}
+    unique = []
+    for i, page in enumerate(pages):
+        digest = hashlib.sha256(page["data"]).hexdigest()
+        page["duplicate_of"] = first_seen.get(digest)
+        if page["duplicate_of"] is None:
+            first_seen[digest] = i
+            unique.append(i)
+    done = dict(zip(unique, await asyncio.gather(*(run(pages[i]) for i in unique))))
+    out = []
+    for i, page in enumerate(pages):
+        src = done[i] if page["duplicate_of"] is None else done[page["duplicate_of"]]
+        out.append({"index": i, "source": page["source"], "page": page["page"], "duplicate_of": page["duplicate_of"],
+                    "text": src["text"], "error": src["error"], "timings": src["timings"] if page["duplicate_of"] is None else {}})
+    return out
+
+def anki_voice_for(item: Dict[str, Any]) -> str:
+    lang = item.get('lang', '')
+    if "俄" in lang or "ru" in lang or item.get('ru'): return "ru-RU-DmitryNeural"
+    elif "法" in lang or "fr" in lang: return "fr-FR-HenriNeural"
+    elif "德" in lang or "de" in lang: return "de-DE-ConradNeural"
+    return "en-US-AriaNeural"
+
+async def synth_anki_audio(export_list, api_key, base_url=None, on_progress=None) -> List[Optional[bytes]]:
+    # 并发合成 (走 TTS 缓存)，结果与 export_list 一一对应，失败的位置为 None
+    # on_progress(ok) 在每个单词完成后回调一次，供后台任务汇报进度
+    sem = asyncio.Semaphore(ANKI_AUDIO_CONCURRENCY)
+    async def synth_one(item):
+        async with sem:
+            try: b, _ = await get_audio_cached_async(item['word'], "Edge (推荐)", anki_voice_for(item), 0, api_key, base_url)
+            except Exception: b = None
+            if on_progress: on_progress(b is not None)
+            return b
+    return await asyncio.gather(*(synth_one(item) for item in export_list))
+
+@metrics.stage("anki_package")
+def build_anki_package(export_list, audios) -> bytes:
+    # genanki 只认文件路径，媒体文件放在本次导出独占的临时目录里，打包完整个目录删掉
+    deck = genanki.Deck(random.randrange(1 << 30, 1 << 31), '跟读助手生词本')
+    model = genanki.Model(
+        random.randrange(1 << 30, 1 << 31), 'Simple Model',
+        fields=[{'name': 'Question'}, {'name': 'Answer'}, {'name': 'Audio'}],
+        templates=[{'name': 'Card 1', 'qfmt': '{{Question}}<br>{{Audio}}', 'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}'}]
+    )
+    with tempfile.TemporaryDirectory(prefix="anki_") as tmp_dir:
+        media_files = []
+        for item, audio_bytes in zip(export_list, audios):
+            audio_field = ""
+            if audio_bytes:
+                # 按内容哈希命名：Anki 的媒体目录是全局的，同名不同内容会互相覆盖
+                fname = f"rh_{hashlib.sha1(audio_bytes).hexdigest()[:16]}.mp3"
+                path = os.path.join(tmp_dir, fname)
+                if not os.path.exists(path):
+                    with open(path, "wb") as f: f.write(audio_bytes)
+                    media_files.append(path)
+                audio_field = f"[sound:{fname}]"
+            deck.add_note(genanki.Note(model=model, fields=[
+                f"<div style='font-size:24px; font-weight:bold;'>{item['word']}</div><br><span style='color:grey'>[{item.get('ipa','')}]</span>",
+                f"🇨🇳 {item.get('zh','')}<br>🇷🇺 {item.get('ru','')}", audio_field
+            ]))
+        pkg = genanki.Package(deck)
+        pkg.media_files = media_files
+        out_stream = io.BytesIO()
+        pkg.write_to_file(out_stream)
+        return out_stream.getvalue()
+
+class ExportJob:
+    def __init__(self, export_list, api_key, base_url):
+        self.id = uuid.uuid4().hex
+        self.export_list = export_list
+        self.total = len(export_list)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.state = "queued"  # queued -> running -> done / failed
+        self.done = 0
+        self.failures = 0
+        self.error: Optional[str] = None
+        self.result: Optional[bytes] = None
+        self.created = time.time()
+        self.finished: Optional[float] = None
+
+    def info(self) -> Dict[str, Any]:
+        return {"job_id": self.id, "state": self.state, "done": self.done, "total": self.total,
+                "failures": self.failures, "error": self.error, "size": len(self.result) if self.result else 0}
+
+class ExportJobManager:
+    """Anki 导出后台任务：固定数量的 worker 协程从队列里取任务执行。
+
+    成品 .apkg 留在内存里，结束 ttl 秒后在下次访问时清理。worker 随 lifespan 启停，
+    没走 lifespan 时 (比如脚本里直接调用) 第一次提交任务会自动启动。
+    """
+    def __init__(self, workers: int, max_pending: int, ttl: float):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs: Dict[str, ExportJob] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if self._tasks: return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _evict_expired(self):
+        now = time.time()
+        for job_id in [j.id for j in self.jobs.values() if j.finished and now - j.finished > self.ttl]:
+            del self.jobs[job_id]
+
+    def submit(self, export_list, api_key, base_url) -> Optional[ExportJob]:
+        # 排队的任务超过上限时返回 None
+        self.start()
+        self._evict_expired()
+        if self._queue.qsize() >= self.max_pending: return None
+        job = ExportJob(export_list, api_key, base_url)
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        self._evict_expired()
+        return self.jobs.get(job_id)
+
+    async def _run(self, job: ExportJob):
+        def on_progress(ok):
+            job.done += 1
+            if not ok: job.failures += 1
+        with metrics.stage("anki_audio"): audios = await synth_anki_audio(job.export_list, job.api_key, job.base_url, on_progress)
+        job.result = await asyncio.to_thread(build_anki_package, job.export_list, audios)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.state = "running"
+            try:
+                await self._run(job)
+                job.state = "done"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                job.state, job.error = "failed", str(e)
+            finally:
+                job.finished = time.time()
+                job.export_list, job.api_key = [], None  # 结束后不再持有单词列表和用户的 API Key
+                self._queue.task_done()
+
+export_jobs = ExportJobManager(ANKI_JOB_WORKERS, ANKI_JOB_MAX_PENDING, ANKI_JOB_TTL)
+
+class StaticSite:
+    """前端打包目录的内存索引：每个文件一份原文 + gzip (+ br) 预压缩版本，各带强 ETag。
+
+    只在 load() 时扫描一次磁盘，之后的请求都是字典查找；重新打包前端后需要重启服务。
+    """
+    COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml", "application/wasm")
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.loaded = False
+
+    def load(self):
+        files = {}
+        if os.path.isdir(self.directory):
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    full = os.path.join(root, name)
+                    with open(full, "rb") as f: data = f.read()
+                    path = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                    files[path] = self._entry(path, data)
+        self.files, self.loaded = files, True
+
+    def _entry(self, path: str, data: bytes) -> Dict[str, Any]:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        variants = {"identity": data}
+        if len(data) >= STATIC_COMPRESS_MIN_BYTES and content_type.startswith(self.COMPRESSIBLE):
+            variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli: variants["br"] = brotli.compress(data, quality=11)
+            variants = {enc: body for enc, body in variants.items() if enc == "identity" or len(body) < len(data)}
+        if path == "index.html": cache = "no-cache"  # 入口页必须每次协商，才能拿到新版本的资源文件名
+        elif re.match(STATIC_IMMUTABLE_PATH, path): cache = "public, max-age=31536000, immutable"
+        else: cache = f"public, max-age={STATIC_DEFAULT_MAX_AGE}"
+        if content_type.startswith(("text/", "application/javascript")): content_type += "; charset=utf-8"
+        return {"variants": variants, "etag": digest, "content_type": content_type, "cache_control": cache}
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        if not self.loaded: self.load()
+        return self.files.get(path)
+
+    @staticmethod
+    def pick_encoding(accept_encoding: str, available) -> str:
+        accepted = {}
+        for item in accept_encoding.split(","):
+            enc, _, params = item.strip().partition(";")
+            q = 1.0
+            if params.strip().startswith("q="):
+                try: q = float(params.strip()[2:])
+                except ValueError: q = 0.0
+            accepted[enc.strip().lower()] = q
+        for enc in ("br", "gzip"):
+            if enc in available and accepted.get(enc, accepted.get("*", 0.0)) > 0: return enc
+        return "identity"
+
+    def response(self, entry: Dict[str, Any], request: Request) -> Response:
+        encoding = self.pick_encoding(request.headers.get("accept-encoding", ""), entry["variants"])
+        etag = f'"{entry["etag"]}"' if encoding == "identity" else f'"{entry["etag"]}-{encoding}"'
+        headers = {"ETag": etag, "Cache-Control": entry["cache_control"], "Vary": "Accept-Encoding"}
+        if encoding != "identity": headers["Content-Encoding"] = encoding
+        if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        body = entry["variants"][encoding]
+        if request.method == "HEAD":
+            return Response(status_code=200, headers={**headers, "Content-Length": str(len(body))}, media_type=entry["content_type"])
+        return Response(content=body, headers=headers, media_type=entry["content_type"])
+
+frontend_site = StaticSite(FRONTEND_DIST_DIR)
+
 # ================= 3. API 接口 =================
 
-app = FastAPI(title="跟读助手 Pro - Backend API", version="3.1.0")
+# /readyz 用：lifespan 启动完成才算就绪，收到 SIGTERM/SIGINT 开始排空后返回 503
+server_state = {"ready": False, "draining": False}
+
+def watch_shutdown_signals():
+    # uvicorn 收到信号后停止接新连接、等在途请求结束再走 lifespan 关闭；在它的处理函数前面先把实例标成排空中
+    if threading.current_thread() is not threading.main_thread(): return
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        previous = signal.getsignal(sig)
+        if not callable(previous): continue
+        def handler(signum, frame, previous=previous):
+            server_state["draining"] = True
+            previous(signum, frame)
+        signal.signal(sig, handler)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watch_shutdown_signals()
+    await asyncio.to_thread(frontend_site.load)
+    export_jobs.start()
+    edge_pool.start()
+    server_state["ready"] = True
+    yield
+    server_state["ready"] = False
+    await export_jobs.stop()
+    await edge_pool.aclose()
+    await http_clients.aclose()
+    image_executor.shutdown(wait=False)
+    pdf_executor.shutdown(wait=False)
+    gtts_executor.shutdown(wait=False)
+
+app = FastAPI(title="跟读助手 Pro - Backend API", version="3.1.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-TTS-Engine", "X-Audio-Hash", "X-Audio-URL"],
 )
 
+class MetricsMiddleware:
+    """按路由模板 (而不是实际路径，避免标签爆炸) 记录请求耗时、状态码和在途请求数；耗时算到响应体发完为止，流式接口也一样"""
+    in_flight: Dict[str, int] = {}
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def route_of(scope) -> str:
+        for route in app.router.routes:
+            if route.matches(scope)[0] == Match.FULL: return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        route = self.route_of(scope)
+        status = {"code": 500}
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start": status["code"] = message["status"]
+            await send(message)
+        self.in_flight[route] = self.in_flight.get(route, 0) + 1
+        t0 = time.perf_counter()
+        try: await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight[route] -= 1
+            labels = {"method": scope["method"], "route": route, "status": status["code"]}
+            metrics.inc("http_requests_total", **labels)
+            metrics.observe("http_request_duration_seconds", time.perf_counter() - t0, **labels)
+
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(RateLimitedError)
+async def rate_limited_handler(request: Request, exc: RateLimitedError):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(max(1, round(exc.retry_after)))})
+
 # API Routes
 class TTSRequest(BaseModel):
     text: str
@@ -133,6 +2072,9 @@ class TTSRequest(BaseModel):
     speed: int
     api_key: Optional[str] = None
     base_url: Optional[str] = None
+    segmented: Optional[bool] = None  # None: 超过 TTS_SEGMENT_THRESHOLD 字符时自动分句并发合成
+    failover: bool = True  # 所选引擎失败时按 TTS_FAILOVER_CHAINS 换引擎重试
+    return_url: bool = False  # True 时不回传 base64，只返回 {"hash", "url", "engine"}，音频走 GET /audio/{hash}
 
 class OCRRequest(BaseModel):
     image_base64: str
@@ -146,6 +2088,12 @@ class LookupRequest(BaseModel):
     api_key: Optional[str] = None
     base_url: Optional[str] = None
 
+class LookupBatchRequest(BaseModel):
+    words: List[str]
+    chat_model: Optional[str] = None
+    api_key: Optional[str] = None
+    base_url: Optional[str] = None
+
 class TranslateRequest(BaseModel):
     text: str
     chat_model: Optional[str] = None
@@ -166,118 +2114,347 @@ class AnkiExportRequest(BaseModel):
     base_url: Optional[str] = None
 
 @app.post("/tts")
-async def tts(req: TTSRequest):
-    b, e = await get_audio_bytes_mixed_async(req.text, req.engine, req.voice_role, req.speed, req.api_key, req.base_url)
+async def tts(req: TTSRequest, response: Response):
+    # 实际出声的引擎写在 X-TTS-Engine 响应头里，音频的内容哈希和地址写在 X-Audio-Hash / X-Audio-URL 里
+    segmented = req.segmented if req.segmented is not None else len(req.text) > TTS_SEGMENT_THRESHOLD
+    synth = get_audio_segmented_async if segmented else get_audio_cached_async
+    if req.failover:
+        b, e, engine = await get_audio_failover_async(req.text, req.engine, req.voice_role, req.speed, req.api_key, req.base_url, synth)
+    else:
+        b, e = await synth(req.text, req.engine, req.voice_role, req.speed, req.api_key, req.base_url)
+        engine = engine_family(req.engine)
     if e: raise HTTPException(500, e)
-    return base64.b64encode(b).decode('utf-8')
+    digest = await audio_cache.publish(b)
+    response.headers["X-TTS-Engine"] = engine
+    response.headers["X-Audio-Hash"] = digest
+    response.headers["X-Audio-URL"] = f"/audio/{digest}"
+    if req.return_url: return {"hash": digest, "url": f"/audio/{digest}", "engine": engine, "size": len(b)}
+    with metrics.stage("base64_encode"): return base64.b64encode(b).decode('utf-8')
+
+@app.api_route("/audio/{digest}", methods=["GET", "HEAD"])
+async def get_audio_by_hash(digest: str, request: Request):
+    # 内容寻址：同一个地址的内容永远不变，所以用强 ETag + immutable；Range / If-Range 由 FileResponse 处理
+    if not re.fullmatch(r"[0-9a-f]{64}", digest): raise HTTPException(404, "Audio not found")
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={AUDIO_URL_MAX_AGE}, immutable"}
+    if_none_match = [t.strip() for t in request.headers.get("if-none-match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match: return Response(status_code=304, headers=headers)
+    path = audio_cache.path_of(digest)
+    if path: return FileResponse(path, media_type="audio/mpeg", headers=headers)
+    data = audio_cache._mem.get(digest)
+    if data is None: raise HTTPException(404, "Audio not found")  # 已被淘汰，重新 POST /tts 即可
+    return Response(content=data, media_type="audio/mpeg", headers={**headers, "Accept-Ranges": "none"})
+
+@app.post("/tts/stream")
+async def tts_stream(req: TTSRequest):
+    # 直接返回 audio/mpeg 分块流，首块到达即可开始播放；完整音频在流结束后写入缓存
+    # 故障转移只能发生在第一块音频之前，开始推流后就不能再换引擎了
+    candidates = tts_engine_chain(req.engine, req.voice_role, req.text, req.api_key) if req.failover else [(req.engine, req.voice_role)]
+    errors = []
+    for engine, voice in candidates:
+        key = AudioCache.make_key(req.text, engine, voice, req.speed)
+        headers = {"X-TTS-Engine": engine_family(engine)}
+        cached = await audio_cache.get(key)
+        if cached is not None: return Response(content=cached, media_type="audio/mpeg", headers=headers)
+        chunks = stream_audio_mixed_async(req.text, engine, voice, req.speed, req.api_key, req.base_url)
+        # 先拿到第一块再发响应头，这样上游一开始就失败时还能换引擎或返回 500
+        t0 = time.monotonic()
+        try:
+            first = await chunks.__anext__()
+        except RateLimitedError: raise
+        except Exception as e:
+            engine_health.record(engine_family(engine), False, time.monotonic() - t0)
+            errors.append(f"{engine_family(engine)}: {'Empty Audio' if isinstance(e, StopAsyncIteration) else e}")
+            continue
+        engine_health.record(engine_family(engine), True, time.monotonic() - t0)
+
+        async def body(key=key, first=first, chunks=chunks):
+            parts = [first]
+            yield first
+            async for part in chunks:
+                parts.append(part)
+                yield part
+            await audio_cache.put(key, b"".join(parts))
+        return StreamingResponse(body(), media_type="audio/mpeg", headers=headers)
+    raise HTTPException(500, "; ".join(errors))
+
+@app.get("/tts/cache")
+async def tts_cache_info(): return audio_cache.info()
+
+@app.post("/tts/cache/purge")
+async def tts_cache_purge(memory: bool = True, disk: bool = True):
+    await audio_cache.purge(memory=memory, disk=disk)
+    return {"status": "ok", "cache": audio_cache.info()}
 
 @app.post("/ocr")
 async def ocr(req: OCRRequest):
     try: img_b = base64.b64decode(req.image_base64)
     except: raise HTTPException(400, "Invalid Image")
-    t, e = await ai_api_call_async("ocr", req.api_key, image_bytes=img_b, ocr_model=req.ocr_model, base_url=req.base_url)
+    t, e = await ocr_image_async(img_b, req.api_key, req.ocr_model, req.base_url)
+    if e == "Invalid Image": raise HTTPException(400, e)
     if e: raise HTTPException(500, e)
     return {"text": t}
 
+async def _capped_body(request: Request, limit: int):
+    # 边读边计数，超限立刻 413，不把整个请求体读进来
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > limit: raise HTTPException(413, "Image too large")
+        yield chunk
+
+@app.get("/ocr/cache")
+async def ocr_cache_info(): return ocr_cache.info()
+
+@app.post("/ocr/cache/purge")
+async def ocr_cache_purge():
+    ocr_cache.purge()
+    return {"status": "ok", "cache": ocr_cache.info()}
+
+def request_api_key(request: Request, fields: Dict[str, str]) -> Optional[str]:
+    # API Key 只从表单字段或 Authorization: Bearer 头取，不收查询参数 (URL 会原样进访问日志和代理日志)
+    auth = request.headers.get("authorization", "")
+    return fields.get("api_key") or (auth[7:] if auth.startswith("Bearer ") else None)
+
+@app.post("/ocr/upload")
+async def ocr_upload(request: Request, ocr_model: Optional[str] = None, base_url: Optional[str] = None):
+    """二进制上传版 /ocr：multipart/form-data (文件字段 + 可选 api_key/ocr_model/base_url 表单字段) 或直接以原始图片作为请求体。
+
+    上传内容写进 SpooledTemporaryFile，小图留在内存、大图落盘，再直接交给预处理，不经过 base64。
+    原始请求体上传时 API Key 放在 Authorization: Bearer 头里。
+    """
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > OCR_UPLOAD_MAX_BYTES: raise HTTPException(413, "Image too large")
+    form, fields = None, {}
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        parser = MultiPartParser(request.headers, _capped_body(request, OCR_UPLOAD_MAX_BYTES), max_files=1, max_fields=10)
+        parser.spool_max_size = OCR_SPOOL_MEMORY
+        try: form = await parser.parse()
+        except MultiPartException as e: raise HTTPException(400, e.message)
+        upload = next((v for v in form.values() if isinstance(v, UploadFile)), None)
+        if upload is None:
+            await form.close()
+            raise HTTPException(400, "Missing image file")
+        spool = upload.file
+        fields = {k: v for k, v in form.items() if isinstance(v, str)}
+    else:
+        spool = tempfile.SpooledTemporaryFile(max_size=OCR_SPOOL_MEMORY)
+        async for chunk in _capped_body(request, OCR_UPLOAD_MAX_BYTES): spool.write(chunk)
+    key = request_api_key(request, fields)
+    try:
+        t, e = await ocr_image_async(spool, key, fields.get("ocr_model") or ocr_model, fields.get("base_url") or base_url)
+    finally:
+        if form is not None: await form.close()
+        else: spool.close()
+    if e == "Invalid Image": raise HTTPException(400, e)
+    if e: raise HTTPException(500, e)
+    return {"text": t}
+
+@app.post("/ocr/batch")
+async def ocr_batch(request: Request, ocr_model: Optional[str] = None, base_url: Optional[str] = None):
+    """批量 OCR：multipart/form-data 里放多张图片和/或 PDF (需安装 pypdfium2)，表单字段同 /ocr/upload。
+
+    返回按上传顺序排列的逐页结果，以及把成功页拼起来的全文。
+    """
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > OCR_BATCH_MAX_BYTES: raise HTTPException(413, "Upload too large")
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"): raise HTTPException(415, "Expect multipart/form-data")
+    parser = MultiPartParser(request.headers, _capped_body(request, OCR_BATCH_MAX_BYTES), max_files=OCR_BATCH_MAX_PAGES, max_fields=10)
+    parser.spool_max_size = OCR_SPOOL_MEMORY
+    try: form = await parser.parse()
+    except MultiPartException as e: raise HTTPException(400, e.message)
+    try:
+        pages = []
+        for name, value in form.multi_items():
+            if not isinstance(value, UploadFile): continue
+            data = await value.read()
+            if data[:5] == b"%PDF-" or value.content_type == "application/pdf":
+                if pdfium is None: raise HTTPException(415, "PDF support requires pypdfium2")
+                budget = OCR_BATCH_MAX_PAGES - len(pages)
+                try: rendered, total = await asyncio.get_running_loop().run_in_executor(pdf_executor, render_pdf_pages, data, budget)
+                except Exception: raise HTTPException(400, f"Invalid PDF: {value.filename}")
+                if total > budget: raise HTTPException(413, f"Too many pages: {value.filename} has {total} pages, {budget} left (max {OCR_BATCH_MAX_PAGES})")
+                pages += [{"source": value.filename or name, "page": n + 1, "data": b} for n, b in enumerate(rendered)]
+            else: pages.append({"source": value.filename or name, "page": 1, "data": data})
+        fields = {k: v for k, v in form.items() if isinstance(v, str)}
+    finally: await form.close()
+    if not pages: raise HTTPException(400, "Missing image file")
+    if len(pages) > OCR_BATCH_MAX_PAGES: raise HTTPException(413, f"Too many pages (max {OCR_BATCH_MAX_PAGES})")
+    key = request_api_key(request, fields)
+    results = await ocr_batch_async(pages, key, fields.get("ocr_model") or ocr_model, fields.get("base_url") or base_url)
+    return {"pages": results, "text": "\n\n".join(r["text"] for r in results if r["text"] and r["duplicate_of"] is None)}
+
 @app.post("/lookup")
 async def lookup(req: LookupRequest):
-    info, e = await ai_api_call_async("lookup", req.api_key, content=req.word, chat_model=req.chat_model, base_url=req.base_url)
+    info, e = await lookup_cached_async(req.word, req.api_key, req.chat_model, req.base_url)
     if e: raise HTTPException(500, e)
     return info
 
+@app.post("/lookup/batch")
+async def lookup_batch(req: LookupBatchRequest):
+    return {"results": await lookup_batch_async(req.words, req.api_key, req.chat_model, req.base_url)}
+
+@app.get("/lookup/cache")
+async def lookup_cache_info(): return lookup_cache.info()
+
+@app.post("/lookup/cache/purge")
+async def lookup_cache_purge():
+    # 只清模型查询结果，生词本预填的词条保留
+    lookup_cache.purge()
+    return {"status": "ok", "cache": lookup_cache.info()}
+
 @app.post("/translate")
 async def translate(req: TranslateRequest):
-    t, e = await ai_api_call_async("trans", req.api_key, content=req.text, chat_model=req.chat_model, base_url=req.base_url)
-    if e: raise HTTPException(500, e)
-    return {"text": t}
+    if not req.api_key: raise HTTPException(500, "Need API Key")
+    paragraphs = translate_paragraph_tasks(req.text, req.api_key, req.chat_model, req.base_url)
+    try: results = await asyncio.gather(*(await_paragraph(p) for p in paragraphs))
+    finally:
+        # 某段抛出 RateLimitedError 时其他段落没人要了，取消掉免得继续消耗用户的 Key
+        for tasks in paragraphs:
+            for task in tasks: task.cancel()
+    for t, e in results:
+        if e: raise HTTPException(500, e)
+    return {"text": "\n\n".join(t for t, _ in results)}
+
+@app.post("/translate/stream")
+async def translate_stream(req: TranslateRequest):
+    # SSE：按原文顺序逐段推送 {"index", "text"} (失败的段落推 {"index", "error"})，最后一条 event: done
+    if not req.api_key: raise HTTPException(500, "Need API Key")
+    paragraphs = translate_paragraph_tasks(req.text, req.api_key, req.chat_model, req.base_url)
+
+    async def events():
+        try:
+            for i, tasks in enumerate(paragraphs):
+                try: t, e = await await_paragraph(tasks)
+                except RateLimitedError as ex: t, e = None, str(ex)
+                msg = {"index": i, "total": len(paragraphs), **({"error": e} if e else {"text": t})}
+                yield f"data: {json.dumps(msg, ensure_ascii=False)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            # 客户端中途断开时取消还没跑完的段落
+            for tasks in paragraphs:
+                for task in tasks: task.cancel()
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/healthz")
+async def healthz(): return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    if server_state["draining"]: return JSONResponse(status_code=503, content={"status": "draining"})
+    if not server_state["ready"]: return JSONResponse(status_code=503, content={"status": "starting"})
+    try: await asyncio.to_thread(vocab_store.version)
+    except Exception as e: return JSONResponse(status_code=503, content={"status": "vocab store unavailable", "error": str(e)})
+    return {"status": "ready"}
+
+@app.get("/upstream/health")
+async def upstream_health(): return {"providers": upstream.info(), "tts_engines": engine_health.info(), "singleflight": singleflight.info(), "quotas": quotas.info(), "edge_pool": edge_pool.info(), "http_clients": http_clients.info()}
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # 缓存、合并、配额、熔断这些状态平时各自维护，抓取时再同步成指标
+    for name, cache in (("audio", audio_cache), ("lookup", lookup_cache), ("ocr", ocr_cache)):
+        hits = sum(v for k, v in cache.stats.items() if k.endswith("hits"))
+        lookups = sum(cache.stats.values())
+        for event, value in cache.stats.items(): metrics.set("cache_events_total", value, kind="counter", cache=name, event=event)
+        metrics.set("cache_hit_ratio", hits / lookups if lookups else 0.0, cache=name)
+    metrics.set("translate_cache_entries", len(translate_cache))
+    for route, count in MetricsMiddleware.in_flight.items(): metrics.set("http_requests_in_flight", count, route=route)
+    metrics.set("singleflight_in_flight", len(singleflight._inflight))
+    metrics.set("edge_pool_idle_connections", len(edge_pool._idle))
+    for event, count in edge_pool.stats.items(): metrics.set("edge_pool_connections_total", count, kind="counter", event=event)
+    for role, count in singleflight.stats.items(): metrics.set("singleflight_calls_total", count, kind="counter", role=role)
+    for provider, bucket in quotas.providers.items():
+        metrics.set("upstream_in_flight", bucket.active, provider=provider)
+        metrics.set("upstream_queued", len(bucket._waiters), provider=provider)
+    for provider, breaker in upstream.breakers.items(): metrics.set("upstream_circuit_open", 1 if breaker.state == "open" else 0, provider=provider)
+    for state in ("queued", "running", "done", "failed"):
+        metrics.set("anki_export_jobs", sum(1 for j in export_jobs.jobs.values() if j.state == state), state=state)
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
 
 @app.get("/config/voices")
 async def voices(): return {"edge": VOICE_MAP_EDGE, "siliconflow": VOICE_MAP_SF, "google_langs": LANG_MAP_GOOGLE}
 
 @app.get("/vocab")
-async def get_vocab(): return load_vocab_data()
+async def get_vocab(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None, lang: Optional[str] = None,
+                    prefix: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None):
+    # 不带 limit 时返回全量列表 (兼容旧前端)；分页时下一页游标放在 X-Next-Cursor 头里
+    # ETag 由存储版本 + 查询参数组成，数据没变时直接 304
+    params = hashlib.sha1(str(sorted(request.query_params.multi_items())).encode("utf-8")).hexdigest()[:12]
+    etag = f'W/"{vocab_store.version()}-{params}"'
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    if limit is not None: limit = max(1, min(limit, VOCAB_PAGE_MAX))
+    with metrics.stage("vocab_load"): items, next_cursor = vocab_store.query(limit, cursor, lang, prefix, date_from, date_to)
+    headers = {"ETag": etag}
+    if next_cursor: headers["X-Next-Cursor"] = next_cursor
+    return Response(content=json.dumps(items, ensure_ascii=False), media_type="application/json", headers=headers)
+
+@app.get("/vocab/changes")
+async def vocab_changes(since: int = 0):
+    # 增量同步：changes 为 null 表示 since 已过期，需要重新拉全量 /vocab
+    with metrics.stage("vocab_load"): version, changes = vocab_store.changes(since)
+    return {"version": version, "changes": changes}
 
 @app.post("/vocab/add")
 async def add_vocab(item: VocabItem):
-    v = load_vocab_data()
-    if not any(x['word'] == item.word for x in v):
-        v.insert(0, item.dict())
-        save_vocab_data(v)
-    return {"status": "ok", "vocab": v}
+    with metrics.stage("vocab_save"): record, created = vocab_store.add(item.dict())
+    if created: lookup_cache.seed([record])
+    return {"status": "ok", "item": record, "created": created}
 
 @app.post("/vocab/delete")
 async def delete_vocab(req: Dict[str, str]):
-    word = req.get("word")
-    v = [x for x in load_vocab_data() if x['word'] != word]
-    save_vocab_data(v)
-    return {"status": "ok", "vocab": v}
+    with metrics.stage("vocab_save"): deleted = vocab_store.delete(req.get("word"), req.get("lang"))
+    return {"status": "ok", "deleted": deleted}
 
 @app.post("/vocab/anki_export")
 async def export_anki_post(req: AnkiExportRequest):
-    all_vocab = load_vocab_data()
-    target_words = set(req.words)
-    export_list = [v for v in all_vocab if v['word'] in target_words]
+    with metrics.stage("vocab_load"): export_list = vocab_store.find(req.words)
     if not export_list: raise HTTPException(400, "Empty selection")
-    
-    deck = genanki.Deck(random.randrange(1 << 30, 1 << 31), '跟读助手生词本')
-    model = genanki.Model(
-        random.randrange(1 << 30, 1 << 31), 'Simple Model',
-        fields=[{'name': 'Question'}, {'name': 'Answer'}, {'name': 'Audio'}],
-        templates=[{'name': 'Card 1', 'qfmt': '{{Question}}<br>{{Audio}}', 'afmt': '{{FrontSide}}<hr id="answer">{{Answer}}'}]
-    )
-    
-    media_files = []
-    temp_files = []
-    for i, item in enumerate(export_list):
-        try:
-            lang = item.get('lang', '')
-            voice_role = "en-US-AriaNeural"
-            if "俄" in lang or "ru" in lang or item.get('ru'): voice_role = "ru-RU-DmitryNeural"
-            elif "法" in lang or "fr" in lang: voice_role = "fr-FR-HenriNeural"
-            elif "德" in lang or "de" in lang: voice_role = "de-DE-ConradNeural"
-            
-            audio_bytes, _ = await get_audio_bytes_mixed_async(item['word'], "Edge (推荐)", voice_role, 0, req.api_key, req.base_url)
-            fname = f"anki_{random.randint(10000,99999)}_{i}.mp3"
-            if audio_bytes:
-                with open(fname, "wb") as f: f.write(audio_bytes)
-                media_files.append(fname)
-                temp_files.append(fname)
-                audio_field = f"[sound:{fname}]"
-            else: audio_field = ""
-            
-            deck.add_note(genanki.Note(model=model, fields=[
-                f"<div style='font-size:24px; font-weight:bold;'>{item['word']}</div><br><span style='color:grey'>[{item.get('ipa','')}]</span>",
-                f"🇨🇳 {item.get('zh','')}<br>🇷🇺 {item.get('ru','')}", audio_field
-            ]))
-        except: continue
-            
-    pkg = genanki.Package(deck)
-    pkg.media_files = media_files
-    out_stream = io.BytesIO()
-    pkg.write_to_file(out_stream)
-    for f in temp_files:
-        if os.path.exists(f): os.remove(f)
-    out_stream.seek(0)
-    return Response(content=out_stream.read(), media_type="application/octet-stream", headers={"Content-Disposition": "attachment; filename=anki_select.apkg"})
+    with metrics.stage("anki_audio"): audios = await synth_anki_audio(export_list, req.api_key, req.base_url)
+    data = await asyncio.to_thread(build_anki_package, export_list, audios)
+    return Response(content=data, media_type="application/octet-stream", headers={"Content-Disposition": "attachment; filename=anki_select.apkg"})
+
+@app.post("/vocab/anki_export/jobs")
+async def submit_anki_export(req: AnkiExportRequest):
+    # 大批量导出走后台任务：立即返回 job_id，前端轮询进度后再下载
+    with metrics.stage("vocab_load"): export_list = vocab_store.find(req.words)
+    if not export_list: raise HTTPException(400, "Empty selection")
+    job = export_jobs.submit(export_list, req.api_key, req.base_url)
+    if job is None: raise HTTPException(503, "Too many export jobs, try again later")
+    return job.info()
+
+@app.get("/vocab/anki_export/jobs/{job_id}")
+async def anki_export_status(job_id: str):
+    job = export_jobs.get(job_id)
+    if not job: raise HTTPException(404, "Job not found")
+    return job.info()
+
+@app.get("/vocab/anki_export/jobs/{job_id}/download")
+async def anki_export_download(job_id: str):
+    job = export_jobs.get(job_id)
+    if not job: raise HTTPException(404, "Job not found")
+    if job.state != "done": raise HTTPException(409, f"Job {job.state}")
+    return Response(content=job.result, media_type="application/octet-stream", headers={"Content-Disposition": "attachment; filename=anki_select.apkg"})
 
 # --- 关键修复：静态文件托管 (网页界面) ---
-# 1. 挂载静态资源 (CSS, JS)
-if os.path.exists("frontend/dist"):
-    app.mount("/assets", StaticFiles(directory="frontend/dist/assets"), name="assets")
-
-# 2. 根路径 "/" 直接返回 index.html (显示网页)
-@app.get("/")
-async def serve_root():
-    if os.path.exists("frontend/dist/index.html"):
-        return FileResponse("frontend/dist/index.html")
+# 文件都在 frontend_site 的内存索引里 (启动时加载并预压缩)，按 Accept-Encoding 选 br / gzip / 原文
+
+# 1. 根路径 "/" 直接返回 index.html (显示网页)
+@app.api_route("/", methods=["GET", "HEAD"])
+async def serve_root(request: Request):
+    entry = frontend_site.get("index.html")
+    if entry: return frontend_site.response(entry, request)
     return {"message": "Backend Online. Frontend not built. Please run 'npm run build' first."}
 
-# 3. 捕获所有其他路径 (React Router 支持)
-@app.get("/{full_path:path}")
-async def serve_spa(full_path: str):
-    # 排除 API 路径
-    if full_path.startswith("api") or full_path.startswith("tts") or full_path.startswith("ocr"):
+# 2. 打包产物里的文件原样返回，其他路径交给 React Router (返回 index.html)
+@app.api_route("/{full_path:path}", methods=["GET", "HEAD"])
+async def serve_spa(full_path: str, request: Request):
+    entry = frontend_site.get(full_path)
+    if entry: return frontend_site.response(entry, request)
+    # 排除 API 路径和不存在的资源文件
+    if full_path.startswith(("api", "tts", "ocr", "assets/")):
         raise HTTPException(404)
-    if os.path.exists("frontend/dist/index.html"):
-        return FileResponse("frontend/dist/index.html")
+    entry = frontend_site.get("index.html")
+    if entry: return frontend_site.response(entry, request)
     return {"message": "Frontend not built"}
\ No newline at end of file
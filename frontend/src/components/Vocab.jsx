@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
 import { Trash2, Volume2, Loader2, Download, CheckSquare, Square } from 'lucide-react';
 
@@ -8,6 +8,7 @@ const Vocab = () => {
   const [playingWord, setPlayingWord] = useState(null);
   const [exporting, setExporting] = useState(false);
   const [selectedWords, setSelectedWords] = useState(new Set());
+  const audioUrls = useRef(new Map()); // 单词 -> /audio/{hash}，再次点击直接播放，由浏览器缓存
 
   const API_URL = `http://${window.location.hostname}:8000`;
 
@@ -49,8 +50,8 @@ const Vocab = () => {
   const handleDelete = async (word) => {
     if (!confirm(`删除 "${word}"?`)) return;
     try {
-      const res = await axios.post(`${API_URL}/vocab/delete`, { word });
-      setVocabList(res.data.vocab);
+      await axios.post(`${API_URL}/vocab/delete`, { word });
+      setVocabList(list => list.filter(v => v.word !== word));
       if (selectedWords.has(word)) { const newSet = new Set(selectedWords); newSet.delete(word); setSelectedWords(newSet); }
     } catch (e) { alert("删除失败"); }
   };
@@ -79,10 +80,17 @@ const Vocab = () => {
     setPlayingWord(item.word);
     try {
       const voiceRole = detectVoice(item);
-      const res = await axios.post(`${API_URL}/tts`, {
-        text: item.word, engine: "Edge (推荐)", voice_role: voiceRole, speed: 0
-      });
-      new Audio("data:audio/mpeg;base64," + res.data).play();
+      const cacheKey = `${item.word}|${voiceRole}`;
+      if (!audioUrls.current.has(cacheKey)) {
+        const res = await axios.post(`${API_URL}/tts`, {
+          text: item.word, engine: "Edge (推荐)", voice_role: voiceRole, speed: 0, return_url: true
+        });
+        audioUrls.current.set(cacheKey, `${API_URL}${res.data.url}`);
+      }
+      const audio = new Audio(audioUrls.current.get(cacheKey));
+      // 服务端缓存淘汰后地址会 404，清掉记录下次重新合成
+      audio.onerror = () => audioUrls.current.delete(cacheKey);
+      await audio.play();
     } catch (e) {} finally { setPlayingWord(null); }
   };
 
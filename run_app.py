@@ -25,7 +25,7 @@ print("=" * 50)
 
 # 定义命令
 # 后端：绑定 0.0.0.0 允许外部访问
-backend_cmd = f"uvicorn backend:app --reload --host 0.0.0.0 --port 8000"
+backend_cmd = f"python serve.py --dev --host 0.0.0.0 --port 8000"
 # 前端：绑定 0.0.0.0
 frontend_cmd = f"npm run dev -- --host"
 
@@ -0,0 +1,97 @@
+"""跟读助手 Pro 后端的生产启动入口 (替代 `uvicorn backend:app --reload`)。
+
+    python serve.py                      # 0.0.0.0:8000，worker 数取 WEB_CONCURRENCY (默认 1)
+    python serve.py --workers 4 --port 8080
+    python serve.py --dev                # 开发模式：单进程 + 改代码自动重载
+
+收到 SIGTERM 后 /readyz 立刻返回 503，停止接新连接，在途请求最多等 --graceful-timeout 秒再退出。
+"""
+import argparse
+import ast
+import importlib.util
+import os
+import sys
+
+import uvicorn
+
+
+def pick(module: str, fallback: str) -> str:
+    # 装了 uvloop / httptools 就用，没装就退回标准库 asyncio / h11
+    return module if importlib.util.find_spec(module) else fallback
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="跟读助手 Pro 后端")
+    parser.add_argument("--host", default=os.environ.get("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WEB_CONCURRENCY", 1)))
+    parser.add_argument("--loop", choices=["auto", "uvloop", "asyncio"], default="auto")
+    parser.add_argument("--http", choices=["auto", "httptools", "h11"], default="auto")
+    parser.add_argument("--keep-alive", type=int, default=15, help="空闲 keep-alive 连接保持秒数")
+    parser.add_argument("--backlog", type=int, default=2048, help="listen() 的等待队列长度")
+    parser.add_argument("--limit-concurrency", type=int, default=None, help="每个 worker 同时处理的连接上限，超出返回 503")
+    parser.add_argument("--graceful-timeout", type=int, default=30, help="退出时等待在途请求的最长秒数")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"), help="信任其 X-Forwarded-* 头的反向代理地址")
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--no-access-log", action="store_true")
+    parser.add_argument("--dev", action="store_true", help="开发模式：单进程 + 自动重载")
+    return parser.parse_args()
+
+
+def backend_settings(*names: str) -> dict:
+    # 直接解析 backend.py 里的常量赋值，不导入它：导入会打开数据库、扫描缓存目录、起线程池，
+    # 主进程只负责拉起 worker，不该有这些副作用，也不能和 worker 抢着做迁移
+    with open("backend.py", encoding="utf-8") as f: tree = ast.parse(f.read())
+    settings = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name) and node.targets[0].id in names:
+            try: settings[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError: pass
+    return settings
+
+
+def multi_worker_warnings() -> list:
+    # 多 worker 部署时哪些状态只在单个进程里
+    cfg = backend_settings("VOCAB_BACKEND", "VOCAB_FILE", "TTS_CACHE_DIR")
+    warnings = []
+    if cfg.get("VOCAB_BACKEND") == "json": warnings.append(f"生词本使用 JSON 存储 ({cfg.get('VOCAB_FILE')})，多进程同时写会互相覆盖，请改用 VOCAB_BACKEND = \"sqlite\"")
+    warnings.append("Anki 后台导出任务保存在进程内存里，轮询/下载可能落到别的 worker 上返回 404，需要会话粘滞或单 worker")
+    warnings.append("上游配额 (QUOTA_*) 按进程计算，实际总速率约为配置值 x worker 数")
+    warnings.append(f"GET /audio/{{hash}} 靠共享的 {cfg.get('TTS_CACHE_DIR', 'tts_cache')} 目录跨 worker 取文件；写盘失败时音频只留在生成它的 worker 内存里，别的 worker 会 404。"
+                    "磁盘容量上限也是各 worker 分别统计的")
+    warnings.append("内存缓存、请求合并、Edge 连接池和 /metrics 指标都是每个 worker 一份")
+    return warnings
+
+
+def warn_per_process_state(workers: int):
+    if workers <= 1: return
+    print(f"⚠️  以 {workers} 个 worker 启动，以下状态不在进程间共享：")
+    for line in multi_worker_warnings(): print(f"   - {line}")
+
+
+def main():
+    args = parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))  # 生词本、缓存等相对路径都以项目目录为准
+    loop = pick("uvloop", "asyncio") if args.loop == "auto" else args.loop
+    http = pick("httptools", "h11") if args.http == "auto" else args.http
+    workers = 1 if args.dev else max(1, args.workers)
+
+    print("=" * 50)
+    print(f"🚀 跟读助手 Pro 后端: http://{args.host}:{args.port}")
+    print(f"⚙️  workers={workers} loop={loop} http={http} keep-alive={args.keep_alive}s backlog={args.backlog}")
+    print("=" * 50)
+    warn_per_process_state(workers)
+
+    uvicorn.run(
+        "backend:app",
+        host=args.host, port=args.port, workers=workers, reload=args.dev,
+        loop=loop, http=http,
+        timeout_keep_alive=args.keep_alive, backlog=args.backlog, limit_concurrency=args.limit_concurrency,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips,
+        log_level=args.log_level, access_log=not args.no_access_log,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())